@@ -3,7 +3,7 @@ from quart import session, redirect, url_for, Blueprint, render_template, reques
 
 import settings
 from funding import login_required
-from funding.factory import openid
+from funding.factory import openid, db
 from funding.models.database import User
 
 
@@ -18,13 +18,13 @@ if openid:
         uid = user['sub']
 
         try:
-            user = User.select().where(User.id == uid).get()
+            user = await db.get(User, User.id == uid)
         except peewee.DoesNotExist:
             user = None
 
         if not user:
             # create new user if it does not exist yet
-            user = User.create(id=uid, username=username)
+            user = await User.create_async(id=uid, username=username)
 
         # user is now logged in
         session['user'] = await user.to_json()
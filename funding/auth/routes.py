@@ -1,6 +1,5 @@
 import bcrypt
 
-import peewee
 from quart import session, redirect, url_for, Blueprint, render_template, request, abort, flash
 from dataclasses import dataclass
 from quart_schema.validation import DataSource
@@ -9,7 +8,7 @@ from email_validator import validate_email, EmailNotValidError
 
 import settings
 from funding import login_required, admin_required, moderator_required
-from funding.factory import openid
+from funding.factory import openid, db
 from funding.auth.models import UserRegisterForm
 from funding.models.database import User, UserRole
 
@@ -31,7 +30,7 @@ async def login():
         try:
             if not username or not password:
                 raise Exception("No credentials")
-            user = User.validate(username, password)
+            user = await User.validate(username, password)
             if not user.enabled:
                 await flash("user is disabled")
                 return await render_template("login.html")
@@ -53,16 +52,15 @@ async def forgot():
 @bp_auth.route("/auth/user/<path:name>/admin/toggle", methods=["POST"])
 @moderator_required
 async def user_admin_toggle(name: str):
-    try:
-        user = User.select().filter(User.username == name).get()
-    except:
+    user = await User.by_username(name)
+    if not user:
         return abort(404)
 
     if user.role == UserRole.admin:
         user.role = UserRole.user
     else:
         user.role = UserRole.admin
-    user.save()
+    await user.save_async()
 
     await flash(f"User is admin: {user.role == UserRole.admin}")
     return redirect(url_for('bp_routes.user_page', name=name))
@@ -71,16 +69,15 @@ async def user_admin_toggle(name: str):
 @bp_auth.route("/auth/user/<path:name>/moderator/toggle", methods=["POST"])
 @moderator_required
 async def user_moderator_toggle(name: str):
-    try:
-        user = User.select().filter(User.username == name).get()
-    except:
+    user = await User.by_username(name)
+    if not user:
         return abort(404)
 
     if user.role == UserRole.moderator:
         user.role = UserRole.user
     else:
         user.role = UserRole.moderator
-    user.save()
+    await user.save_async()
 
     await flash(f"User is moderator: {user.role == UserRole.moderator}")
     return redirect(url_for('bp_routes.user_page', name=name))
@@ -89,16 +86,15 @@ async def user_moderator_toggle(name: str):
 @bp_auth.route("/auth/user/<path:name>/enabled/toggle", methods=["POST"])
 @moderator_required
 async def user_enabled_toggle(name: str):
-    try:
-        user = User.select().filter(User.username == name).get()
-    except:
+    user = await User.by_username(name)
+    if not user:
         return abort(404)
 
     if user.is_admin:
         return "cannot enable/disable an admin user"
 
     user.enabled = not user.enabled
-    user.save()
+    await user.save_async()
 
     if user.enabled:
         msg = f"user '{user.username}' has been unbanned"
@@ -125,16 +121,13 @@ async def register_post(data: UserRegisterForm):
         await flash("Password length must exceed 5 characters")
         return await render_template('register.html', username=data.username, password=data.password, email=data.email)
 
-    try:
-        User.select().where(User.username == data.username).get()
+    if await User.by_username(data.username):
         await flash("Username taken.")
         return await render_template('register.html', username=data.username, password=data.password, email=data.email)
-    except peewee.DoesNotExist:
-        pass
 
-    user_count = User.select().count()
+    user_count = await db.count(User.select())
     hashed = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt())
-    user = User.create(
+    user = await User.create_async(
         username=data.username,
         password=hashed,
         mail=data.email,
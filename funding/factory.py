@@ -3,8 +3,9 @@ from typing import List, Set, Optional
 from datetime import datetime
 
 import timeago
-from peewee import PostgresqlDatabase, SqliteDatabase, ProgrammingError
+from peewee import SqliteDatabase, ProgrammingError
 from playhouse.shortcuts import ReconnectMixin
+from peewee_async import PooledPostgresqlDatabase, Manager
 from aiocryptocurrency.coins import Coin, SUPPORTED_COINS
 from aiocryptocurrency.coins.nero import Wownero, Monero
 from aiocryptocurrency.coins.firo import Firo
@@ -16,11 +17,19 @@ from quart_session_openid import OpenID
 from funding.utils.discourse import Discourse
 from funding.utils.globals import COINS_LOOKUP
 from funding.utils.rates import Rates
+from funding.utils.ledger import Ledger
+from funding.utils.api_cache import ApiCache
+from funding.utils.images import ImageService
+from funding.utils.gravatar import Gravatar
 import settings
 
 cache = None
 peewee = None
 rates = Rates()
+ledger = Ledger()
+api_cache = ApiCache("api_proposals")
+images = ImageService()
+gravatar = Gravatar()
 app: Optional[Quart] = None
 openid: Optional[OpenID] = None
 crypto_provider: Optional[Firo] = None
@@ -29,7 +38,7 @@ discourse = Discourse()
 proposal_task = None
 
 
-class ReconnectingPGDatabase(ReconnectMixin, PostgresqlDatabase):
+class ReconnectingPGDatabase(ReconnectMixin, PooledPostgresqlDatabase):
     def __init__(self, *args, **kwargs):
         import peewee as pw
         super(ReconnectingPGDatabase, self).__init__(*args, **kwargs)
@@ -44,17 +53,37 @@ database = ReconnectingPGDatabase(
     user=settings.DB_USER,
     password=settings.DB_PASSWD,
     host=settings.DB_HOST,
-    port=settings.DB_PORT
+    port=settings.DB_PORT,
+    max_connections=settings.DB_POOL_SIZE
 )
 
+# async queries go through the connection pool of this manager, e.g:
+# `await db.execute(query)`, `await db.get(query)`
+db = Manager(database)
+
 
 async def _setup_postgres(app: Quart):
     import peewee
+    from playhouse.migrate import PostgresqlMigrator, migrate
     import funding.models.database
     models = peewee.Model.__subclasses__()
+    migrator = PostgresqlMigrator(database)
+    migrated = []
     for m in models:
         m.create_table()
 
+        # add columns that were introduced after the table got created
+        table = m._meta.table_name
+        columns = [c.name for c in database.get_columns(table)]
+        missing = [f for f in m._meta.sorted_fields if f.column_name not in columns]
+        if missing:
+            migrate(*[migrator.add_column(table, f.column_name, f) for f in missing])
+            migrated.append(m)
+
+    from funding.models.database import Proposal
+    if Proposal in migrated:
+        Proposal.reconcile_funds()
+
 
 async def _setup_openid(app: Quart):
     global openid
@@ -126,7 +155,10 @@ async def _setup_cache(app: Quart):
 async def _setup_tasks(app: Quart):
     """Schedules a series of tasks at an interval."""
     asyncio.create_task(discourse.fetch_task())
+    asyncio.create_task(discourse.outbox_task())
     asyncio.create_task(rates.rate_task())
+    asyncio.create_task(ledger.ledger_task())
+    asyncio.create_task(images.captcha_task())
     from funding.proposals.task import ProposalFundedTask
     asyncio.create_task(ProposalFundedTask().is_funded_task())
 
@@ -153,7 +185,7 @@ def create_app():
     app.secret_key = settings.APP_SECRET
 
     @app.template_filter()
-    def to_usd(val: float):
+    def to_usd(val: float) -> float:
         global rates
         return rates.to_usd(val)
 
@@ -223,6 +255,12 @@ def create_app():
 
         from funding.utils import crumbs
 
+    @app.after_serving
+    async def shutdown():
+        await discourse.close()
+        await gravatar.close()
+        images.close()
+
     @app.before_request
     async def set_request_ctx():
         from funding.models.database import User, UserRole
@@ -237,7 +275,7 @@ def create_app():
             return
 
         try:
-            user = User.by_uuid(ses['uuid'])
+            user = await User.by_uuid(ses['uuid'])
             if not user or not user.enabled:
                 raise Exception("clear session")
             g.user = user
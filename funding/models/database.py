@@ -8,23 +8,22 @@ from copy import deepcopy
 from datetime import datetime
 
 import peewee as pw
-from peewee import JOIN
 from aiocryptocurrency.coins import TransactionSet, Transaction
 import playhouse.postgres_ext as pwpg
 from quart import url_for, session, current_app as app, g
-from funding.utils import safu
+from funding.utils import safu, memoized, invalidate_memo
 from slugify import slugify
 
 import settings
-from funding.factory import crypto_provider, discourse, coin
+from funding.factory import discourse, coin, ledger, db, api_cache, rates, images
 from funding.proposals.models import ProposalUpsert
 from funding.models.enums import UserRole, ProposalStatus, WithdrawalStatus, ProposalCategory
-from funding.models.utils import EnumField
+from funding.models.utils import EnumField, AsyncModel
 from funding.utils.discourse import DiscourseComment
 from funding.utils.markdown import generate_html
 
 
-class User(pw.Model):
+class User(AsyncModel, pw.Model):
     uuid = pw.UUIDField(primary_key=True, default=uuid4)
     created = pw.DateTimeField(default=datetime.now)
     modified = pw.DateTimeField(default=datetime.now)
@@ -62,18 +61,35 @@ class User(pw.Model):
         return self.role.value >= UserRole.moderator.value
 
     @staticmethod
-    def by_uuid(uuid):
+    async def by_uuid(uuid):
         try:
-            return User.select()\
-                .join(Proposal, pw.JOIN.LEFT_OUTER) \
-                .where(User.uuid == uuid).get()
+            return await db.get(User.select()
+                                .join(Proposal, pw.JOIN.LEFT_OUTER)
+                                .where(User.uuid == uuid))
         except Exception as ex:
             pass
 
     @staticmethod
-    def validate(username: str, password: str) -> Optional['User']:
+    async def by_username(username: str) -> Optional['User']:
         try:
-            user = User.select().filter(User.username == username).get()
+            return await db.get(User, username=username)
+        except User.DoesNotExist:
+            pass
+
+    @staticmethod
+    def listing(*filters) -> pw.ModelSelect:
+        """Users annotated with `proposal_count`, newest first"""
+        q = User.select(User, pw.fn.COUNT(Proposal.uuid).alias('proposal_count')) \
+            .join(Proposal, pw.JOIN.LEFT_OUTER) \
+            .group_by(User.uuid)
+        if filters:
+            q = q.where(*filters)
+        return q.order_by(User.created.desc())
+
+    @staticmethod
+    async def validate(username: str, password: str) -> Optional['User']:
+        try:
+            user = await db.get(User, username=username)
             if bcrypt.checkpw(password.encode(), user.password.encode()):
                 return user
         except:
@@ -89,7 +105,7 @@ class User(pw.Model):
         }
 
 
-class Proposal(pw.Model):
+class Proposal(AsyncModel, pw.Model):
     uuid = pw.UUIDField(primary_key=True, default=uuid4)
     created = pw.DateTimeField(default=datetime.now)
     modified = pw.DateTimeField(default=datetime.now)
@@ -112,6 +128,11 @@ class Proposal(pw.Model):
     funds_target: float = pw.FloatField(null=False)
     funds_progress: float = pw.FloatField(null=False, default=0)
 
+    # materialized totals, kept up to date by `Ledger` and `funds_transfer`
+    funds_raised: float = pw.FloatField(null=False, default=0)
+    funds_spent: float = pw.FloatField(null=False, default=0)
+    funds_tx_count: int = pw.IntegerField(null=False, default=0)
+
     crypto_address_donation: str = pw.TextField(null=True)
     crypto_address_payment_id: str = pw.TextField(null=True)
 
@@ -122,14 +143,29 @@ class Proposal(pw.Model):
         super(Proposal, self).__init__(*args, **kwargs)
         self._is_new = False
         self._events: List['Event'] = []
+        # Discourse posts, queued once the proposal is saved
+        self._discourse_posts: List[str] = []
+
+    def save(self, *args, **kwargs):
+        invalidate_memo(self)
+        return super(Proposal, self).save(*args, **kwargs)
+
+    async def save_async(self, force_insert=False):
+        invalidate_memo(self)
+        return await super(Proposal, self).save_async(force_insert=force_insert)
+
+    async def after_write(self):
+        await api_cache.invalidate()
+        if isinstance(self.discourse_topic_id, int):
+            for body in self._discourse_posts:
+                await discourse.enqueue(self.discourse_topic_id, body)
+        self._discourse_posts = []
 
     @property
     async def comments(self) -> List[DiscourseComment]:
-        cache = app.session_interface
-        res = await cache.get(self.comments_cache_key)
-        if res:
-            return [DiscourseComment.parse_raw(c) for c in json.loads(res)]
-        return []
+        if not self.discourse_topic_id:
+            return []
+        return await discourse.cached_comments(self.discourse_topic_id)
 
     def can_edit(self, user: User):
         if user.role.value == UserRole.admin.value or \
@@ -147,8 +183,12 @@ class Proposal(pw.Model):
         return target
 
     @property
-    def comments_cache_key(self):
-        return f"topic_comments_{self.discourse_topic_id}"
+    def funds_target_usd(self) -> float:
+        return rates.to_usd(self.funds_target)
+
+    @property
+    def funds_raised_usd(self) -> float:
+        return rates.to_usd(self.funds_raised)
 
     @property
     def discourse_topic_link(self):
@@ -165,6 +205,7 @@ class Proposal(pw.Model):
         return True
 
     @property
+    @memoized
     async def transactions(self) -> TransactionSet:
         incoming = await self._fetch_incoming_txs(
             address=self.crypto_address_donation,
@@ -172,9 +213,9 @@ class Proposal(pw.Model):
         )
         outgoing = TransactionSet()
         try:
-            for w in Withdrawal.select().filter(
+            for w in await db.execute(Withdrawal.select().filter(
                     Withdrawal.proposal == self,
-                    Withdrawal.status == WithdrawalStatus.completed):
+                    Withdrawal.status == WithdrawalStatus.completed)):
                 outgoing.add(Transaction(
                     amount=w.amount,
                     txid=w.txid,
@@ -183,16 +224,15 @@ class Proposal(pw.Model):
                 ))
         except Exception as ex:
             app.logger.error(ex)
-        return incoming + outgoing
+        # `TransactionSet.__add__` extends the left operand in-place; keep
+        # the (shared) ledger index intact
+        return TransactionSet() + incoming + outgoing
 
     @property
-    async def spent_remaining(self) -> float:
-        ts = await self.transactions
-        sum_in = ts.sum('in')
-        sum_out = ts.sum('out')
-        if sum_in == 0:
+    def spent_remaining(self) -> float:
+        if self.funds_raised == 0:
             return 0.0
-        res = sum_in - sum_out
+        res = self.funds_raised - self.funds_spent
         if res <= 0:
             return 0.0
         return round(res, 10)
@@ -204,24 +244,17 @@ class Proposal(pw.Model):
         return a
 
     @property
-    async def spent_pct(self) -> float:
-        ts = await self.transactions
-        incoming = ts.filter('in')
-        outgoing = ts.filter('out')
-        incoming_sum = incoming.sum('in')
-        outgoing_sum = outgoing.sum('out')
-        if outgoing_sum <= 0 or incoming_sum <= 0:
+    def spent_pct(self) -> float:
+        if self.funds_spent <= 0 or self.funds_raised <= 0:
             return 0.0
 
-        res = 100 * float(outgoing_sum) / float(incoming_sum)
+        res = 100 * float(self.funds_spent) / float(self.funds_raised)
         res = round(res, 2)
         return res
 
     @property
-    async def raised_remaining(self):
-        ts = await self.transactions
-        ts = ts.filter('in')
-        return self.funds_target - ts.sum()
+    def raised_remaining(self):
+        return self.funds_target - self.funds_raised
 
     @property
     async def raised(self) -> TransactionSet:
@@ -229,24 +262,55 @@ class Proposal(pw.Model):
         return txs.filter('in')
 
     @property
-    async def raised_pct(self):
-        ts = await self.transactions
-        ts = ts.filter('in')
-
-        part = ts.sum()
-        if part == 0.0:
+    def raised_pct(self):
+        if self.funds_raised == 0.0:
             return 0
 
-        pct = 100 * float(part) / float(self.funds_target)
+        pct = 100 * float(self.funds_raised) / float(self.funds_target)
         pct = round(pct, 2)
         # if pct > 100:
         #     pct = 100
+        return pct
 
-        if pct > self.funds_progress:
-            self.funds_progress = pct
-            self.save()
+    @staticmethod
+    async def add_funds_raised(address: str, amount: float, count: int):
+        """Atomically bumps the funding totals after `count` new deposits.
+        Callers invalidate `api_cache` once their transaction committed."""
+        raised = Proposal.funds_raised + amount
+        await db.execute(Proposal.update(
+            funds_raised=raised,
+            funds_tx_count=Proposal.funds_tx_count + count,
+            funds_progress=pw.fn.GREATEST(Proposal.funds_progress, 100 * raised / Proposal.funds_target)
+        ).where(Proposal.crypto_address_donation == address))
+
+    async def add_view(self):
+        """Atomically bumps the view counter. Deliberately leaves the API
+        cache alone; cached listings pick up views when they expire."""
+        await db.execute(Proposal.update(views=Proposal.views + 1)
+                         .where(Proposal.uuid == self.uuid))
+        self.views += 1
+        self._dirty.discard('views')
+
+    async def add_funds_spent(self, amount: float):
+        """Atomically bumps the funding totals after a withdrawal"""
+        invalidate_memo(self)
+        await db.execute(Proposal.update(funds_spent=Proposal.funds_spent + amount)
+                         .where(Proposal.uuid == self.uuid))
+        await api_cache.invalidate()
+        self.funds_spent += amount
+        self._dirty.discard('funds_spent')
 
-        return pct
+    @staticmethod
+    def reconcile_funds():
+        """Recomputes the funding totals of all proposals from `Deposit` and `Withdrawal`"""
+        raised = Deposit.select(pw.fn.COALESCE(pw.fn.SUM(Deposit.amount), 0)).where(
+            Deposit.address == Proposal.crypto_address_donation)
+        tx_count = Deposit.select(pw.fn.COUNT(Deposit.uuid)).where(
+            Deposit.address == Proposal.crypto_address_donation)
+        spent = Withdrawal.select(pw.fn.COALESCE(pw.fn.SUM(Withdrawal.amount), 0)).where(
+            Withdrawal.proposal == Proposal.uuid,
+            Withdrawal.status == WithdrawalStatus.completed)
+        Proposal.update(funds_raised=raised, funds_tx_count=tx_count, funds_spent=spent).execute()
 
     @staticmethod
     async def post_topic(proposal: 'Proposal', href_to_proposal: str):
@@ -268,6 +332,7 @@ class Proposal(pw.Model):
             app.logger.error(f"Discourse new_topic error: {ex}")
 
     def set_discourse_topic_id(self, topic_id: int, user: User):
+        invalidate_memo(self)
         if not isinstance(topic_id, int) or topic_id == self.discourse_topic_id:
             return
         if not user.is_moderator:
@@ -276,6 +341,7 @@ class Proposal(pw.Model):
         self.modified = datetime.now()
 
     async def set_status(self, status: ProposalStatus, user: User = None):
+        invalidate_memo(self)
         if not isinstance(status, ProposalStatus) or status is self.status:
             return
         if user and not user.is_moderator:
@@ -291,13 +357,10 @@ class Proposal(pw.Model):
             message = f"Status changed from '{status_from}' to '{status_to}'"
             self._events.append(Event(message=message, proposal=self, user=user))
 
-            try:
-                if isinstance(self.discourse_topic_id, int):
-                    await discourse.new_post(self.discourse_topic_id, message)
-            except:
-                pass
+            self._discourse_posts.append(message)
 
     async def set_category(self, cat: ProposalCategory, user: User = None):
+        invalidate_memo(self)
         if not isinstance(cat, ProposalCategory) or cat is self.category:
             return
         self.modified = datetime.now()
@@ -315,13 +378,10 @@ class Proposal(pw.Model):
                 proposal=self,
                 user=user))
 
-            try:
-                if isinstance(self.discourse_topic_id, int):
-                    await discourse.new_post(self.discourse_topic_id, message)
-            except:
-                pass
+            self._discourse_posts.append(message)
 
     def set_markdown(self, markdown: str, user: User):
+        invalidate_memo(self)
         if not isinstance(markdown, str) or \
                 self.markdown == markdown:
             return
@@ -337,6 +397,7 @@ class Proposal(pw.Model):
                 user=user))
 
     async def set_funds_target(self, funds_target: float, user: User = None):
+        invalidate_memo(self)
         if self.funds_target == funds_target:
             return
 
@@ -358,13 +419,10 @@ class Proposal(pw.Model):
             proposal=self,
             user=user))
 
-        if isinstance(self.discourse_topic_id, int):
-            try:
-                await discourse.new_post(self.discourse_topic_id, body=message)
-            except:
-                pass
+        self._discourse_posts.append(message)
 
     def set_addr_receiving(self, addr_receiving: str, user: User = None):
+        invalidate_memo(self)
         if not addr_receiving or addr_receiving == self.addr_receiving:
             return
 
@@ -382,6 +440,7 @@ class Proposal(pw.Model):
         return f"{slugify(title)}-{self.user.username}"
 
     async def generate_deposit_address(self, user: User = None):
+        invalidate_memo(self)
         from funding.factory import crypto_provider
         if self.crypto_address_donation:
             return
@@ -393,6 +452,7 @@ class Proposal(pw.Model):
             self.crypto_address_donation = blob['address']
             if 'payment_id' in blob:
                 self.crypto_address_payment_id = blob['payment_id']
+            images.pregenerate_qr(self.crypto_address_donation)
 
             self._events.append(Event(message=f"Donation address generated", proposal=self, user=user))
         except Exception as ex:
@@ -454,22 +514,44 @@ class Proposal(pw.Model):
         proposal.set_markdown(data.markdown, user)
 
         proposal.modified = datetime.now()
-        proposal.save(force_insert=proposal._is_new)
+        await proposal.save_async(force_insert=proposal._is_new)
 
         for event in proposal._events:
             event.proposal = proposal
-            event.save(force_insert=True)
+            await event.save_async(force_insert=True)
         return proposal
 
     @staticmethod
     async def by_slug(slug: str):
         try:
-            p = Proposal.select().join(Event, JOIN.LEFT_OUTER).where(Proposal.slug == slug).get()
+            p = (await Proposal.fetch_listing(Proposal.listing(Proposal.slug == slug), events=True))[0]
             await p.check_funding_status()
             return p
         except Exception as ex:
             pass
 
+    @staticmethod
+    def listing(*filters, fields: list = None) -> pw.ModelSelect:
+        """Proposals with their author joined in, newest first. Optionally
+        only selects `fields` (columns of `Proposal` and `User`)."""
+        q = Proposal.select(*(fields or [Proposal, User])).join(User).switch(Proposal)
+        if filters:
+            q = q.where(*filters)
+        return q.order_by(Proposal.created.desc())
+
+    @staticmethod
+    async def fetch_listing(query: pw.ModelSelect, events=False, withdrawals=False) -> List['Proposal']:
+        """Executes a `listing()` query. Optionally prefetches the events (newest
+        first) and completed withdrawals, with one extra query each."""
+        subqueries = []
+        if events:
+            subqueries.append(Event.select().order_by(Event.created.desc()))
+        if withdrawals:
+            subqueries.append(Withdrawal.select().where(Withdrawal.status == WithdrawalStatus.completed))
+        if subqueries:
+            return list(await db.prefetch(query, *subqueries))
+        return list(await db.execute(query))
+
     @safu
     async def check_funding_status(self) -> bool:
         """Auto-move proposals to 'wip' if fully funded"""
@@ -478,57 +560,42 @@ class Proposal(pw.Model):
         if self.status != ProposalStatus.funding_required:
             return False
 
-        res = await self.raised_pct
-        if res >= 100:
+        if self.raised_pct >= 100:
             await self.set_status(ProposalStatus.wip)
-            self.save()
+            await self.save_async()
             return True
         return False
 
     @staticmethod
-    async def _fetch_incoming_txs(address, payment_id=None, cache_expiry=60) -> Optional[TransactionSet]:
-        txset = TransactionSet()
+    async def _fetch_incoming_txs(address, payment_id=None) -> TransactionSet:
         if not address:
-            return txset
-
-        cache = app.session_interface
-        key = f"txs_{address}"
+            return TransactionSet()
 
-        # try to get it from the `g` object
-        if hasattr(g, key):
-            val = getattr(g, key)
-            if isinstance(val, str):
-                results = json.loads(val)
-                return TransactionSet.from_json(results)
-            return val
+        # maybe the ledger has it indexed?
+        txs = ledger.get(address, payment_id)
+        if txs is not None:
+            return txs
 
-        # maybe it is in cache?
-        data = await cache.get(key)
-        if data:
-            results = json.loads(data)
-            return TransactionSet.from_json(results)
+        txs = TransactionSet()
+        for deposit in await db.execute(Deposit.select().where(Deposit.address == address)):
+            txs.add(deposit.to_transaction())
 
-        try:
-            # contact RPC; list txs
-            txs = await crypto_provider.list_txs(
-                address=address,
-                payment_id=payment_id,
-                minimum_confirmations=3)
-            serialized = txs.serialize()
-        except Exception as ex:
-            app.logger.error(f"Could not list_txs(); {ex}")
-            return txset
-
-        await cache.set(key, serialized, cache_expiry)
-        setattr(g, key, serialized)
+        ledger.set(address, payment_id, txs)
         return txs
 
     class Meta:
         from funding.factory import database
         database = database
+        # funding totals are only written through atomic increments
+        only_save_dirty = True
+        # keyset pagination on listings, see `paginate()`
+        indexes = (
+            (('status', 'created'), False),
+            (('user', 'created'), False),
+        )
 
 
-class Event(pw.Model):
+class Event(AsyncModel, pw.Model):
     uuid = pw.UUIDField(primary_key=True, default=uuid4)
     created = pw.DateTimeField(default=datetime.now)
     modified = pw.DateTimeField(default=datetime.now)
@@ -538,12 +605,15 @@ class Event(pw.Model):
     proposal: Proposal = pw.ForeignKeyField(Proposal, backref='events', null=False)
     user: User = pw.ForeignKeyField(User, null=True)
 
+    async def after_write(self):
+        await api_cache.invalidate()
+
     class Meta:
         from funding.factory import database
         database = database
 
 
-class Withdrawal(pw.Model):
+class Withdrawal(AsyncModel, pw.Model):
     uuid = pw.UUIDField(primary_key=True, default=uuid4)
     created = pw.DateTimeField(default=datetime.now)
     modified = pw.DateTimeField(default=datetime.now)
@@ -553,12 +623,49 @@ class Withdrawal(pw.Model):
     status = EnumField(choices=WithdrawalStatus, default=WithdrawalStatus.pending)
     proposal = pw.ForeignKeyField(Proposal, backref="withdrawals")
 
+    async def after_write(self):
+        await api_cache.invalidate()
+
     class Meta:
         from funding.factory import database
         database = database
 
 
-class System(pw.Model):
+class Deposit(AsyncModel, pw.Model):
+    """Incoming transfer to a donation address, synced from the wallet by `Ledger`"""
+    uuid = pw.UUIDField(primary_key=True, default=uuid4)
+    created = pw.DateTimeField(default=datetime.now)
+    modified = pw.DateTimeField(default=datetime.now)
+
+    txid = pw.TextField(null=False)
+    address = pw.TextField(null=False, index=True)
+    payment_id = pw.TextField(null=True, index=True)
+    amount = pw.FloatField(null=False)
+    blockheight = pw.IntegerField(null=False, index=True)
+    confirmations = pw.IntegerField(default=0)
+    date = pw.DateTimeField(default=datetime.now)
+
+    def to_transaction(self) -> Transaction:
+        confirmations = self.confirmations
+        if ledger.height:
+            confirmations = max(confirmations, ledger.height - self.blockheight)
+        return Transaction(
+            amount=self.amount,
+            txid=self.txid,
+            direction='in',
+            date=self.date,
+            blockheight=self.blockheight,
+            confirmations=confirmations)
+
+    class Meta:
+        from funding.factory import database
+        database = database
+        indexes = (
+            (('txid', 'address'), True),
+        )
+
+
+class System(AsyncModel, pw.Model):
     uuid = pw.UUIDField(primary_key=True, default=uuid4)
     created = pw.DateTimeField(default=datetime.now)
     modified = pw.DateTimeField(default=datetime.now)
@@ -569,3 +676,21 @@ class System(pw.Model):
     class Meta:
         from funding.factory import database
         database = database
+
+
+class DiscourseOutbox(AsyncModel, pw.Model):
+    """Pending post to a Discourse topic, sent by `Discourse.outbox_task`"""
+    uuid = pw.UUIDField(primary_key=True, default=uuid4)
+    created = pw.DateTimeField(default=datetime.now)
+    modified = pw.DateTimeField(default=datetime.now)
+
+    topic_id = pw.IntegerField(null=False)
+    body = pw.TextField(null=False)
+    attempts = pw.IntegerField(default=0)
+    next_attempt = pw.DateTimeField(default=datetime.now, index=True)
+    error = pw.TextField(null=True)
+
+    class Meta:
+        from funding.factory import database
+        database = database
+
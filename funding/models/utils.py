@@ -1,3 +1,11 @@
+import json
+import base64
+import logging
+from uuid import UUID
+from datetime import datetime
+from contextlib import contextmanager
+from typing import List, Optional, Tuple, AsyncIterator
+
 import peewee as pw
 
 
@@ -13,3 +21,135 @@ class EnumField(pw.IntegerField):
 
     def python_value(self, value):
         return self.choices(value)
+
+
+class AsyncModel:
+    """Async counterparts of `pw.Model` methods, running on the
+    connection pool of `funding.factory.db`"""
+    @classmethod
+    async def create_async(cls, **data):
+        from funding.factory import db
+        obj = await db.create(cls, **data)
+        await obj.after_write()
+        return obj
+
+    async def save_async(self, force_insert=False):
+        from funding.factory import db
+        if force_insert:
+            await db.execute(type(self).insert(**self.__data__))
+            self._dirty.clear()
+        else:
+            await db.update(self)
+        await self.after_write()
+
+    async def after_write(self):
+        """Called after `create_async()` and `save_async()`"""
+        pass
+
+
+class QueryCounter(logging.Handler):
+    """Counts the queries logged by peewee and peewee-async"""
+    def __init__(self):
+        super(QueryCounter, self).__init__(level=logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+
+@contextmanager
+def assert_max_queries(limit: int):
+    """Raises `AssertionError` when the enclosed block runs more than
+    `limit` queries, e.g:
+
+        with assert_max_queries(2):
+            proposals = await Proposal.fetch_listing(Proposal.listing())
+            [p.user.username for p in proposals]
+    """
+    counter = QueryCounter()
+    logger = logging.getLogger('peewee')
+    level = logger.level
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    try:
+        yield counter
+    finally:
+        logger.removeHandler(counter)
+        logger.setLevel(level)
+
+    if counter.count > limit:
+        raise AssertionError(f"expected at most {limit} queries, got {counter.count}")
+
+
+class Page:
+    """A slice of a listing, with keyset cursors to its neighbours"""
+    def __init__(self, items: list, next_cursor: str = None, prev_cursor: str = None):
+        self.items = items
+        self.next = next_cursor
+        self.prev = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(obj: pw.Model) -> str:
+    blob = json.dumps([obj.created.isoformat(), str(obj._pk)])
+    return base64.urlsafe_b64encode(blob.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[datetime, UUID]]:
+    """`None` for cursors that were not made by `encode_cursor`"""
+    try:
+        created, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created), UUID(pk)
+    except Exception:
+        return
+
+
+async def paginate(query: pw.ModelSelect, model, after: str = None, before: str = None, limit: int = 50) -> Page:
+    """Keyset pagination over `(created, pk)`, newest first. Pass the `next`
+    cursor of a page as `after`, or its `prev` cursor as `before`."""
+    from funding.factory import db
+    key = pw.Tuple(model.created, model._meta.primary_key)
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+
+    if before:
+        query = query.where(key > pw.Tuple(*before)) \
+            .order_by(model.created.asc(), model._meta.primary_key.asc())
+    else:
+        if after:
+            query = query.where(key < pw.Tuple(*after))
+        query = query.order_by(model.created.desc(), model._meta.primary_key.desc())
+
+    rows: List[pw.Model] = list(await db.execute(query.limit(limit + 1)))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return Page([])
+
+    if before:
+        rows.reverse()
+        return Page(rows,
+                    next_cursor=encode_cursor(rows[-1]),
+                    prev_cursor=encode_cursor(rows[0]) if more else None)
+    return Page(rows,
+                next_cursor=encode_cursor(rows[-1]) if more else None,
+                prev_cursor=encode_cursor(rows[0]) if after else None)
+
+
+async def iterate(query: pw.ModelSelect, model, batch: int = 200) -> AsyncIterator[pw.Model]:
+    """Yields all rows of `query`, newest first, fetching `batch` rows at a
+    time by keyset so that neither memory nor a pooled connection is held
+    for the whole result set."""
+    after = None
+    while True:
+        page = await paginate(query, model, after=after, limit=batch)
+        for obj in page:
+            yield obj
+        if not page.next:
+            return
+        after = page.next
@@ -1,3 +1,5 @@
+import json
+
 from slugify import slugify
 from quart_schema import QuartSchema, validate_request, validate_response
 from quart_schema.validation import DataSource
@@ -9,7 +11,7 @@ from quart import (
 
 import settings
 from funding import login_required
-from funding.factory import openid, crypto_provider
+from funding.factory import openid, crypto_provider, discourse
 from funding.utils.crumbs import *
 from funding.utils.markdown import generate_html, MARKDOWN_PROPOSAL_DEFAULT
 from funding.proposals.models import ProposalUpsert, CommentPost, CommentPostReply
@@ -31,3 +33,23 @@ async def upsert(data: ProposalUpsert):
 
     url = url_for('bp_proposals.view', slug=proposal.slug)
     return jsonify({"url": url})
+
+
+@bp_proposals_api.post("/discourse")
+async def discourse_webhook():
+    """Discourse webhook for post events; keeps proposal comments current
+    between the periodic syncs."""
+    body = await request.get_data()
+    if not discourse.verify_webhook(body, request.headers.get('X-Discourse-Event-Signature')):
+        abort(403)
+
+    event = request.headers.get('X-Discourse-Event')
+    if event not in ["post_created", "post_edited", "post_destroyed"]:
+        return jsonify({"status": "ignored"})
+
+    try:
+        await discourse.on_webhook(event, json.loads(body)['post'])
+    except Exception as ex:
+        current_app.logger.error(f"discourse webhook error: {ex}")
+        return jsonify({"error": "could not process event"}), 500
+    return jsonify({"status": "ok"})
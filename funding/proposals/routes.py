@@ -30,8 +30,7 @@ async def view(slug: str):
         abort(404)
 
     if settings.VIEW_COUNTER:
-        proposal.views += 1
-        proposal.save()
+        await proposal.add_view()
 
     crumbs = proposal_crumbs_base(proposal)
     crumbs.append(Crumb(
@@ -96,7 +95,7 @@ async def funds_transfer(data: ProposalFundsTransfer, slug: str = None):
     if session['captcha'] != data.captcha:
         raise Exception("bad captcha")
 
-    spent_remaining = await proposal.spent_remaining
+    spent_remaining = proposal.spent_remaining
     if spent_remaining <= 0 or \
             amount > spent_remaining:
         raise Exception("Cannot spend this amount")
@@ -109,25 +108,24 @@ async def funds_transfer(data: ProposalFundsTransfer, slug: str = None):
     except Exception as ex:
         return f"Error sending to '{destination}': {ex}"
 
-    Withdrawal.create(
+    await Withdrawal.create_async(
         txid=txid,
         amount=amount,
         status=WithdrawalStatus.completed,
         proposal=proposal
     )
+    await proposal.add_funds_spent(amount)
 
     message = f"Payment of {round(amount, 10)} " \
               f"{coin['ticker']} sent"
 
-    Event.create(
+    await Event.create_async(
         message=message,
         proposal=proposal,
         user=g.user)
 
-    try:
-        await discourse.new_post(proposal.discourse_topic_id, message)
-    except:
-        pass
+    if isinstance(proposal.discourse_topic_id, int):
+        await discourse.enqueue(proposal.discourse_topic_id, message)
 
     await flash(message)
     return redirect(url_for('bp_proposals.funds', slug=proposal.slug))
@@ -3,6 +3,7 @@ from typing import List
 
 from quart import current_app
 
+from funding.factory import db
 from funding.utils import safu
 from funding.models.database import Proposal, ProposalStatus, ProposalCategory, Event
 
@@ -18,11 +19,12 @@ class ProposalFundedTask:
 
     @safu
     async def _is_funded(self):
-        q: List[Proposal] = Proposal.select().filter(Proposal.status == ProposalStatus.funding_required)
+        q: List[Proposal] = await db.execute(
+            Proposal.select().filter(Proposal.status == ProposalStatus.funding_required))
         for p in q:
             try:
                 await p.check_funding_status()
                 for event in p._events:
-                    event.save(force_insert=True)
+                    await event.save_async(force_insert=True)
             except Exception as ex:
                 current_app.logger.error(f"_is_funded task: {ex}")
@@ -1,5 +1,4 @@
-import os
-from uuid import uuid4
+import json
 from typing import Optional
 
 from dataclasses import dataclass
@@ -14,39 +13,37 @@ from quart import (
 )
 
 import settings
-from funding import login_required
-from funding.factory import openid
-from funding.utils import get_ip
-from funding.utils.qr import QrCodeGenerator, QR_LOCK
+from funding import login_required, admin_required
+from funding.factory import openid, db, api_cache, images, gravatar
+from funding.utils import get_ip, pagination_args, MEMO_STATS
 from funding.utils.crumbs import *
-from funding.utils.markdown import generate_html
-from funding.utils.gravatar import gravatar_download
+from funding.utils.markdown import generate_html_async, RENDER_CACHE, PREVIEW_CACHE
 from funding.models.database import User, Proposal, ProposalStatus, ProposalCategory
+from funding.models.utils import paginate, iterate
 
 bp_routes = Blueprint('bp_routes', __name__)
 
-proposals_by_status = lambda status: Proposal.select()\
-    .filter(Proposal.status == status)\
-    .order_by(Proposal.created.desc())
+proposals_by_status = lambda status: Proposal.listing(Proposal.status == status)
 
 
 @bp_routes.get("/")
 async def root():
-    q = Proposal.select()
+    q = Proposal.listing()
     if not g.user.is_moderator:
         q = q.filter(Proposal.status != ProposalStatus.disabled)
-    proposals = q.order_by(Proposal.created.desc())
+    page = await paginate(q, Proposal, **pagination_args())
 
-    return await render_template('index.html', proposals=proposals)
+    return await render_template('index.html', proposals=page.items, page=page)
 
 
 @bp_routes.get("/ideas/")
 async def ideas():
-    proposals = proposals_by_status(ProposalStatus.idea)
+    page = await paginate(proposals_by_status(ProposalStatus.idea), Proposal, **pagination_args())
     return await render_template(
         'proposals.html',
         title='Ideas',
-        proposals=proposals,
+        proposals=page.items,
+        page=page,
         state=ProposalStatus.idea,
         crumbs=[crumb_home, crumb_ideas]
     )
@@ -54,11 +51,12 @@ async def ideas():
 
 @bp_routes.get("/funding-required/")
 async def funding():
-    proposals = proposals_by_status(ProposalStatus.funding_required)
+    page = await paginate(proposals_by_status(ProposalStatus.funding_required), Proposal, **pagination_args())
     return await render_template(
         'proposals.html',
         title='Funding required',
-        proposals=proposals,
+        proposals=page.items,
+        page=page,
         state=ProposalStatus.funding_required,
         crumbs=[crumb_home, crumb_funding]
     )
@@ -66,22 +64,24 @@ async def funding():
 
 @bp_routes.get("/work-in-progress/")
 async def wip():
-    proposals = proposals_by_status(ProposalStatus.wip)
+    page = await paginate(proposals_by_status(ProposalStatus.wip), Proposal, **pagination_args())
     return await render_template(
         'proposals.html',
         title='Work in Progress',
-        proposals=proposals,
+        proposals=page.items,
+        page=page,
         state=ProposalStatus.wip,
         crumbs=[crumb_home, crumb_wip])
 
 
 @bp_routes.get("/completed-proposals/")
 async def completed():
-    proposals = proposals_by_status(ProposalStatus.completed)
+    page = await paginate(proposals_by_status(ProposalStatus.completed), Proposal, **pagination_args())
     return await render_template(
         'proposals.html',
         title='Completed',
-        proposals=proposals,
+        proposals=page.items,
+        page=page,
         state=ProposalStatus.completed,
         crumbs=[crumb_home, crumb_completed])
 
@@ -103,18 +103,19 @@ async def search():
     q = q.where(User.address.is_null(False))
     q = q.limit(100)
 
-    users = [u for u in q]
+    users = [u for u in await db.execute(q)]
     return await render_template('search.html', users=users)
 
 
 @bp_routes.get("/users")
 async def users_page():
-    q = User.select()
+    q = User.listing()
     if g.user.is_anon:
         q = q.filter(User.enabled == True)
 
-    users = q.order_by(User.created.desc())
-    return await render_template('users.html', users=users)
+    page = await paginate(q, User, **pagination_args())
+    users_count = await db.count(q)
+    return await render_template('users.html', users=page.items, page=page, users_count=users_count)
 
 
 @bp_routes.get("/user/<path:name>")
@@ -122,25 +123,20 @@ async def user_page(name: str):
     if not name or len(name) <= 1:
         raise Exception("invalid name")
 
-    try:
-        u = User.select().where(
-            User.username == name
-        ).get()
-    except:
-        u = None
+    u = await User.by_username(name)
 
-    proposals = []
+    page = None
     if u:
-        q = Proposal.select()
+        q = Proposal.listing(Proposal.user == u)
         if not g.user.is_moderator:
             q = q.filter(Proposal.status != ProposalStatus.disabled)
 
-        q = q.filter(Proposal.user == u)
-        proposals = q.order_by(Proposal.created.desc())
+        page = await paginate(q, Proposal, **pagination_args())
 
     return await render_template(
         'user.html',
-        proposals=proposals,
+        proposals=page.items if page else [],
+        page=page,
         u=u)
 
 
@@ -165,48 +161,121 @@ async def about():
         crumbs=[crumb_home, crumb_about])
 
 
+# API field name -> (columns to select, serializer)
+API_PROPOSAL_FIELDS = {
+    "user": ((User.username,), lambda p: p.user.username),
+    "headline": ((Proposal.title,), lambda p: p.title),
+    "content": ((Proposal.html,), lambda p: p.html),
+    "markdown": ((Proposal.markdown,), lambda p: p.markdown),
+    "slug": ((Proposal.slug,), lambda p: p.slug),
+    "discourse_topic_link": ((Proposal.discourse_topic_id,), lambda p: p.discourse_topic_link or None),
+    "category": ((Proposal.category,), lambda p: ProposalCategory.to_string(p.category)),
+    "status": ((Proposal.status,), lambda p: ProposalStatus.to_string(p.status)),
+    "views": ((Proposal.views,), lambda p: p.views if settings.VIEW_COUNTER else None),
+    "addr_donation": ((Proposal.crypto_address_donation,), lambda p: p.crypto_address_donation),
+    "date_posted": ((), lambda p: str(p.created)),
+    "date_updated": ((Proposal.modified,), lambda p: str(p.modified)),
+    "date_posted_epoch": ((), lambda p: p.created.timestamp()),
+    "funded_pct": ((Proposal.funds_raised, Proposal.funds_target), lambda p: round(p.raised_pct, 4)),
+    "funds_target": ((Proposal.funds_target,), lambda p: p.funds_target)
+}
+
+# everything but the large text columns
+API_PROPOSAL_SUMMARY = [k for k in API_PROPOSAL_FIELDS if k not in ["content", "markdown"]]
+
+
 @bp_routes.route("/api/1/proposals")
 async def api_proposals_list():
-    q = Proposal.select()
-    q = q.filter(Proposal.status != ProposalStatus.disabled)
-    proposals: List[Proposal] = q.order_by(Proposal.created.desc())
-
-    data = []
-    for p in proposals:
-        item = {
-            "user": p.user.username,
-            "headline": p.title,
-            "content": p.html,
-            "markdown": p.markdown,
-            "slug": p.slug,
-            "discourse_topic_link": None,
-            "category": ProposalCategory.to_string(p.category),
-            "status": ProposalStatus.to_string(p.status),
-            "views": None,
-            "addr_donation": p.crypto_address_donation,
-            "date_posted": str(p.created),
-            "date_updated": str(p.modified),
-            "date_posted_epoch": p.created.timestamp(),
-            "funded_pct": 0,
-            "funds_target": p.funds_target
-        }
-
-        if settings.VIEW_COUNTER:
-            item["views"] = p.views
-
-        if p.discourse_topic_link:
-            item['discourse_topic_link'] = p.discourse_topic_link
-
-        try:
-            item["funded_pct"] = round(await p.raised_pct, 4)
-        except Exception as ex:
-            msg = f"API funded_pct error: {ex}"
-            current_app.logger.error(msg)
-            raise Exception(msg)
-
-        data.append(item)
-
-    return jsonify({"data": data})
+    """
+    :param fields: comma separated subset of `API_PROPOSAL_FIELDS`
+    :param mode: `summary` to leave out `content` and `markdown`
+    :param limit: page size, up to 100
+    :param after/before: keyset cursors, see `next`/`prev` in the response
+    """
+    variant = request.query_string.decode()
+    version = await api_cache.version()
+    cached = await api_cache.get(variant, version)
+    if cached:
+        return api_cache.response(cached)
+
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 100)
+    except ValueError:
+        limit = 50
+
+    fields = _api_proposal_fields()
+    if fields is None:
+        return jsonify({"error": "unknown field(s)"}), 400
+
+    page = await paginate(_api_proposal_query(fields), Proposal, limit=limit, **pagination_args())
+    data = [_api_proposal_item(p, fields) for p in page]
+
+    body = json.dumps({"data": data, "next": page.next, "prev": page.prev})
+    return api_cache.response(await api_cache.set(variant, version, body))
+
+
+@bp_routes.route("/api/1/stats")
+@admin_required
+async def api_stats():
+    """Counters of this worker since it started"""
+    return jsonify({
+        "memo": dict(MEMO_STATS),
+        "markdown": RENDER_CACHE.to_json(),
+        "markdown_preview": PREVIEW_CACHE.to_json()
+    })
+
+
+@bp_routes.route("/api/1/proposals/export")
+async def api_proposals_export():
+    """
+    Streams all proposals, one JSON object per line, or as a single
+    JSON array with `?format=json`. Takes `fields` and `mode` like
+    `/api/1/proposals`.
+    """
+    fields = _api_proposal_fields()
+    if fields is None:
+        return jsonify({"error": "unknown field(s)"}), 400
+    query = _api_proposal_query(fields)
+
+    async def ndjson():
+        async for p in iterate(query, Proposal):
+            yield json.dumps(_api_proposal_item(p, fields)) + "\n"
+
+    async def array():
+        sep = "["
+        async for p in iterate(query, Proposal):
+            yield sep + json.dumps(_api_proposal_item(p, fields))
+            sep = ","
+        yield "[]" if sep == "[" else "]"
+
+    if request.args.get('format') == 'json':
+        return Response(array(), mimetype='application/json')
+    return Response(ndjson(), mimetype='application/x-ndjson')
+
+
+def _api_proposal_fields() -> Optional[list]:
+    """Requested API fields, from `?fields=` or `?mode=summary`. None if
+    an unknown field was asked for."""
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        if any(f not in API_PROPOSAL_FIELDS for f in fields):
+            return
+        return fields
+    if request.args.get('mode') == 'summary':
+        return API_PROPOSAL_SUMMARY
+    return list(API_PROPOSAL_FIELDS)
+
+
+def _api_proposal_query(fields: list):
+    # `created` and `uuid` are always needed for the pagination cursors
+    columns = [Proposal.uuid, Proposal.created]
+    for f in fields:
+        columns += [c for c in API_PROPOSAL_FIELDS[f][0] if c not in columns]
+    return Proposal.listing(Proposal.status != ProposalStatus.disabled, fields=columns)
+
+
+def _api_proposal_item(p: Proposal, fields: list) -> dict:
+    return {f: API_PROPOSAL_FIELDS[f][1](p) for f in fields}
 
 
 @bp_routes.get('/lib/qr/<path:address>')
@@ -216,65 +285,64 @@ async def utils_qr_image(address: str):
     :param address: valid receiving address
     :return:
     """
-    async with QR_LOCK:
-        cache = current_app.session_interface
-        qr = QrCodeGenerator()
-        if not qr.exists(address):
-            # create a new QR code
-            ip = get_ip()
-            cache_key = 'qr_ip_%s' % ip
-            hit = await cache.get(cache_key)
-
-            if hit and ip not in ['127.0.0.1', 'localhost']:
-                return Response('Wait a bit before generating a new QR', 403)
-
-            await cache.set(cache_key, "val", expiry=3)
-
-            created = qr.create(address)
-            if not created:
-                raise Exception('Could not create QR code')
-
-        from_dir = os.path.join(current_app.static_folder, 'qr')
-        return await send_from_directory(from_dir, f'{address}.png')
+    cache = current_app.session_interface
+    image = await images.qr(address, render=False)
+    if not image:
+        # create a new QR code
+        ip = get_ip()
+        cache_key = 'qr_ip_%s' % ip
+        hit = await cache.get(cache_key)
+
+        if hit and ip not in ['127.0.0.1', 'localhost']:
+            return Response('Wait a bit before generating a new QR', 403)
+
+        await cache.set(cache_key, "val", expiry=3)
+
+        image = await images.qr(address)
+        if not image:
+            raise Exception('Could not create QR code')
+
+    # the image of an address never changes
+    data, etag = image
+    if request.if_none_match.contains(etag):
+        resp = Response("", status=304)
+    else:
+        resp = Response(data, mimetype='image/png')
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 31536000
+    resp.cache_control.immutable = True
+    return resp
 
 
 @bp_routes.get('/lib/gravatar/')
 @bp_routes.get('/lib/gravatar/<path:hash>')
 async def utils_gravatar(hash: str = None):
-    """:return: path to image"""
-    _dir = os.path.join(current_app.static_folder, "gravatar")
-    fn = f"{hash}.png"
-    dest = os.path.join(_dir, fn)
-
+    """:return: avatar thumbnail, `?s=` picks the size"""
     try:
-        if not os.path.exists(dest):
-            await gravatar_download(
-                hash=hash,
-                save_to_dir=_dir,
-                filename=fn)
-
-        return await send_from_directory(
-            directory=_dir,
-            file_name=fn
-        )
+        size = int(request.args.get('s', 64))
+    except ValueError:
+        size = 64
 
+    try:
+        path = await gravatar.avatar(hash, size)
     except Exception as ex:
         current_app.logger.error(f"Unable to fetch gravatar image: {ex}")
+        return await send_from_directory(
+            directory=current_app.static_folder,
+            file_name='user.png'
+        )
 
-    return await send_from_directory(
-        directory=current_app.static_folder,
-        file_name='user.png'
-    )
+    resp = await send_file(path, mimetype='image/png')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 31536000
+    resp.cache_control.immutable = True
+    return resp
 
 
 @bp_routes.get("/lib/captcha")
-def utils_captcha():
-    font = settings.CAPTCHA_TTF
-    secret = uuid4().hex[:4]
-
-    from funding.utils.captcha import FundingCaptcha
-    image = FundingCaptcha(fonts=[font])
-    data = image.generate(secret)
+async def utils_captcha():
+    secret, data = await images.captcha()
 
     session['captcha'] = secret
     return Response(data, mimetype='image/jpg')
@@ -286,10 +354,10 @@ class MarkdownToHtmlPost(BaseModel):
 
 @bp_routes.post("/lib/markdown/html")
 @validate_request(MarkdownToHtmlPost, source=DataSource.JSON)
-def utils_markdown_to_html(data: MarkdownToHtmlPost):
+async def utils_markdown_to_html(data: MarkdownToHtmlPost):
     if len(data.markdown) >= 20000:
         raise Exception("")
-    html = generate_html(data.markdown)
+    html = await generate_html_async(data.markdown, cache=PREVIEW_CACHE)
     return jsonify({
         "html": html
     })
@@ -13,7 +13,7 @@ from io import BytesIO
 import settings
 import aiohttp
 import aiofiles
-from quart import request, current_app as app, Response, url_for
+from quart import request, current_app as app, Response, url_for, g, has_request_context
 
 
 def remote_address():
@@ -32,6 +32,47 @@ def safu(func):
     return wrapper
 
 
+MEMO_STATS = Counter()
+
+
+def memoized(func):
+    """Memoizes an async method per instance for the duration of the
+    current request. `MEMO_STATS` counts the calls that were saved."""
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not has_request_context():
+            return await func(self, *args, **kwargs)
+
+        if not hasattr(g, '_memo'):
+            g._memo = {}
+        key = (self.__class__, self._pk, func.__name__)
+        if key in g._memo:
+            MEMO_STATS[f"{func.__name__}_saved"] += 1
+            return g._memo[key]
+
+        MEMO_STATS[f"{func.__name__}_fetched"] += 1
+        result = await func(self, *args, **kwargs)
+        g._memo[key] = result
+        return result
+    return wrapper
+
+
+def invalidate_memo(obj):
+    """Drops the values `memoized` holds for `obj` in the current request"""
+    if not has_request_context() or not hasattr(g, '_memo'):
+        return
+    for key in [k for k in g._memo if k[:2] == (obj.__class__, obj._pk)]:
+        del g._memo[key]
+
+
+def pagination_args() -> dict:
+    """Keyset cursors from the query string, see `funding.models.utils.paginate`"""
+    return {
+        "after": request.args.get('after'),
+        "before": request.args.get('before')
+    }
+
+
 def get_ip():
     if settings.X_FORWARDED:
         return request.headers.get('X-Forwarded-For')
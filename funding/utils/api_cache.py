@@ -0,0 +1,68 @@
+import json
+import time
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+from quart import current_app, request, Response
+
+
+class ApiCache:
+    """Versioned Redis cache for JSON API responses. Writes to the underlying
+    data call `invalidate()`, which bumps the version and thereby orphans
+    all cached responses (they expire on their own)."""
+    def __init__(self, name: str, expiry: int = 300):
+        self.name = name
+        self._expiry = expiry
+        self._version_key = f"{name}_version"
+
+    async def invalidate(self):
+        cache = current_app.session_interface
+        await cache.backend.set(self._version_key, str(time.time()))
+
+    async def version(self) -> float:
+        """Read this before running the query whose result goes to `set()`"""
+        cache = current_app.session_interface
+        res = await cache.get(self._version_key)
+        return float(res) if res else 0.0
+
+    def _key(self, version: float, variant: str) -> str:
+        digest = hashlib.md5(variant.encode()).hexdigest()
+        return f"{self.name}_{version}_{digest}"
+
+    async def get(self, variant: str, version: float) -> Optional[dict]:
+        cache = current_app.session_interface
+        res = await cache.get(self._key(version, variant))
+        if res:
+            return json.loads(res)
+
+    async def set(self, variant: str, version: float, body: str) -> dict:
+        """Stores `body` under the version read before it was queried, so an
+        `invalidate()` in between orphans the entry instead of poisoning it"""
+        cache = current_app.session_interface
+        entry = {
+            "etag": hashlib.md5(body.encode()).hexdigest(),
+            "modified": version or time.time(),
+            "body": body
+        }
+        await cache.set(self._key(version, variant), json.dumps(entry), expiry=self._expiry)
+        return entry
+
+    @staticmethod
+    def response(entry: dict) -> Response:
+        """Answers conditional GETs with a 304"""
+        modified = datetime.utcfromtimestamp(int(entry['modified']))
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(entry['etag'])
+        else:
+            since = request.if_modified_since
+            not_modified = since is not None and since.replace(tzinfo=None) >= modified
+
+        if not_modified:
+            resp = Response("", status=304)
+        else:
+            resp = Response(entry['body'], mimetype='application/json')
+        resp.set_etag(entry['etag'])
+        resp.last_modified = modified
+        return resp
@@ -1,12 +1,14 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Dict, Set
 import json
-from datetime import datetime
+import time
+import hmac
+import hashlib
 import asyncio
-from typing import Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import aiohttp
 from quart import current_app
+from markupsafe import Markup
 from pydantic import BaseModel
 
 import settings
@@ -21,6 +23,9 @@ class DiscourseComment(BaseModel):
     created_at: datetime
     topic_id: int
     avatar_template: str
+    post_id: int = 0
+    post_number: int = 0
+    rendered: str = ""
 
     class Config:
         use_enum_values = True
@@ -28,6 +33,8 @@ class DiscourseComment(BaseModel):
     @property
     def markdown_to_html(self):
         from funding.utils.markdown import generate_html
+        if self.rendered:
+            return Markup(self.rendered)
         return generate_html(self.markdown)
 
     @property
@@ -37,9 +44,12 @@ class DiscourseComment(BaseModel):
 
 
 class Discourse:
+    """Discourse API client. All requests go through one long-lived pooled
+    session, at most `_max_concurrency` at a time."""
     def __init__(self):
-        self._max_concurrency = 4
+        self._max_concurrency = 8
         self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
         self._headers = {
             "User-Agent": "funding",
             "Api-Key": settings.DISCOURSE_API_KEY,
@@ -49,61 +59,243 @@ class Discourse:
             "User-Agent": self._headers['User-Agent']
         }
 
+        # topic_id -> seconds the last refresh of that topic took
+        self.timings: Dict[int, float] = {}
+
+        # topic_id -> (highest_post_number, time of last full sync)
+        self._synced: Dict[int, Tuple[int, float]] = {}
+        self._full_sync_interval = 86400
+        # with the webhook configured the poller is only a consistency sweep
+        self._interval = 3600 if settings.DISCOURSE_WEBHOOK_SECRET else 900
+        self._expiry = 86400 * 2
+
+        # outbound post queue (`DiscourseOutbox`)
+        self._outbox_wakeup = asyncio.Event()
+        self._outbox_batch = 50
+        self._outbox_max_attempts = 20
+        self._outbox_max_backoff = 3600
+        self._outbox_lease = 300
+
+        # topic_id -> (version, comments), decoded comments as last read from the cache
+        self._decoded: Dict[int, Tuple[str, List[DiscourseComment]]] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency,
+                                             keepalive_timeout=60,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
     async def fetch_task(self):
         while True:
             await self._fetch_task()
-            await asyncio.sleep(3610)
+            await asyncio.sleep(self._interval)
 
     @safu
     async def _fetch_task(self):
+        from funding.factory import db
         from funding.models.database import Proposal, ProposalStatus
-        q: List[Proposal] = Proposal.select() \
+        q: List[Proposal] = await db.execute(Proposal.select()
             .filter(Proposal.status != ProposalStatus.disabled,
                     Proposal.status != ProposalStatus.completed,
-                    Proposal.discourse_topic_id.is_null(False))
+                    Proposal.discourse_topic_id.is_null(False)))
+
+        start = time.monotonic()
+        await asyncio.gather(*[self._refresh_topic(p) for p in q])
+        if self.timings:
+            slowest = max(self.timings, key=self.timings.get)
+            current_app.logger.info(f"discourse: refreshed {len(q)} topics in "
+                                    f"{time.monotonic() - start:.2f}s, slowest topic "
+                                    f"{slowest} took {self.timings[slowest]:.2f}s")
+
+    async def _refresh_topic(self, p):
+        """Only fetches posts that are new, or were edited, since the last sync"""
+        topic_id = p.discourse_topic_id
+        start = time.monotonic()
+        try:
+            topic = await self._topic(topic_id)
+            if not topic:
+                return
+
+            known = await self._load_comments(topic_id)
+
+            highest, full_at = self._synced.get(topic_id, (None, 0))
+            full = time.time() - full_at > self._full_sync_interval
+            if full:
+                known = []
+            elif known:
+                edited = await self._edited(topic_id, known)
+                if not edited and highest == topic['highest_post_number']:
+                    return
+                known = [c for c in known if c.post_id not in edited]
+
+            comments = await self.get_comments(topic_id, topic=topic, known=known)
+            if comments:
+                await self._store_comments(topic_id, comments)
+            self._synced[topic_id] = (topic['highest_post_number'], time.time() if full else full_at)
+            self.timings[topic_id] = time.monotonic() - start
+        except Exception as ex:
+            msg = f"discourse topic id {topic_id} error: {ex}"
+            current_app.logger.error(msg)
+
+    async def _edited(self, topic_id: int, known: List[DiscourseComment]) -> Set[int]:
+        """Ids of the posts in `known` that were edited or removed since,
+        checked with one bulk call without the raw markdown"""
+        updated = {c.post_id: c.updated_at for c in known if c.post_id}
+        edited = set(updated)
+        for post in await self._get_posts(topic_id, list(updated), raw=False):
+            if datetime.fromisoformat(post['updated_at'].replace('Z', '+00:00')) == updated.get(post['id']):
+                edited.discard(post['id'])
+        return edited
+
+    @staticmethod
+    def verify_webhook(body: bytes, signature: str) -> bool:
+        """Checks the `X-Discourse-Event-Signature` header of a webhook call"""
+        if not settings.DISCOURSE_WEBHOOK_SECRET or not signature:
+            return False
+        digest = hmac.new(settings.DISCOURSE_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(f"sha256={digest}", signature)
+
+    async def on_webhook(self, event: str, post: dict):
+        """Applies a `post_created`, `post_edited` or `post_destroyed` event
+        to the cached comments of that topic, if it belongs to a proposal."""
+        from funding.factory import db
+        from funding.models.database import Proposal
+        topic_id = post['topic_id']
+        if not await db.count(Proposal.select().where(Proposal.discourse_topic_id == topic_id)):
+            return
+
+        comments = {c.post_id: c for c in await self._load_comments(topic_id)}
+
+        if event == "post_destroyed":
+            comments.pop(post['id'], None)
+        elif 'raw' in post:
+            comments[post['id']] = self._to_comment(post)
+        else:
+            return
+
+        comments = sorted(comments.values(), key=lambda c: (c.post_number, c.created_at))
+        per_topic = settings.DISCOURSE_MAX_COMMENTS_PER_TOPIC
+        if per_topic >= 1:
+            comments = comments[-abs(per_topic):]
+        await self._store_comments(topic_id, comments)
 
+    async def cached_comments(self, topic_id: int) -> List[DiscourseComment]:
+        """Comments of a topic for display. Decoded once per cache version,
+        so a page view costs one small Redis read."""
         cache = current_app.session_interface
-        for p in q:
-            try:
-                res = await cache.get(p.comments_cache_key)
-                if res:
-                    return
+        version = await cache.get(f"topic_comments_{topic_id}_version")
+        if not version:
+            return []
+
+        hit = self._decoded.get(topic_id)
+        if hit and hit[0] == version:
+            return hit[1]
+
+        comments = [c for c in await self._load_comments(topic_id)
+                    if c.author != settings.DISCOURSE_USERNAME]
+        self._decoded[topic_id] = (version, comments)
+        return comments
 
-                comments = await self.get_comments(p.discourse_topic_id)
-                serialized = [c.json() for c in comments]
+    @staticmethod
+    async def _load_comments(topic_id: int) -> List[DiscourseComment]:
+        cache = current_app.session_interface
+        res = await cache.get(f"topic_comments_{topic_id}")
+        if not res:
+            return []
+        return [DiscourseComment.parse_raw(c) for c in json.loads(res)]
+
+    async def _store_comments(self, topic_id: int, comments: List[DiscourseComment]):
+        cache = current_app.session_interface
+        await cache.set(f"topic_comments_{topic_id}", json.dumps([c.json() for c in comments]),
+                        expiry=self._expiry)
+        await cache.set(f"topic_comments_{topic_id}_version", str(time.time()), expiry=self._expiry)
 
-                if serialized:
-                    await cache.set(p.comments_cache_key, json.dumps(serialized), expiry=3610)
+    async def enqueue(self, topic_id: int, body: str):
+        """Queues a post to a topic; `outbox_task` sends it"""
+        from funding.models.database import DiscourseOutbox
+        await DiscourseOutbox.create_async(topic_id=topic_id, body=body)
+        self._outbox_wakeup.set()
+
+    async def outbox_task(self):
+        while True:
+            await self._outbox_task()
+            try:
+                await asyncio.wait_for(self._outbox_wakeup.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                pass
+            self._outbox_wakeup.clear()
+
+    @safu
+    async def _outbox_task(self):
+        """Sends due posts, one post per topic with the queued messages
+        joined. Failures are retried with exponential backoff."""
+        from funding.factory import db
+        from funding.models.database import DiscourseOutbox
+
+        # claim due rows by pushing them `_outbox_lease` ahead, so other
+        # workers skip them; rows of a crashed worker come due again
+        due = DiscourseOutbox.select(DiscourseOutbox.uuid) \
+            .where(DiscourseOutbox.next_attempt <= datetime.now(),
+                   DiscourseOutbox.attempts < self._outbox_max_attempts) \
+            .order_by(DiscourseOutbox.created) \
+            .limit(self._outbox_batch) \
+            .for_update('FOR UPDATE SKIP LOCKED')
+        q: List[DiscourseOutbox] = list(await db.execute(
+            DiscourseOutbox.update(next_attempt=datetime.now() + timedelta(seconds=self._outbox_lease))
+            .where(DiscourseOutbox.uuid.in_(due))
+            .returning(DiscourseOutbox)))
+
+        by_topic: Dict[int, List[DiscourseOutbox]] = {}
+        for item in q:
+            by_topic.setdefault(item.topic_id, []).append(item)
+
+        async def _send(topic_id: int, items: List[DiscourseOutbox]):
+            uuids = [i.uuid for i in items]
+            try:
+                await self.new_post(topic_id, "\n\n".join(i.body for i in items))
             except Exception as ex:
-                msg = f"discourse topic id {p.discourse_topic_id} error: {ex}"
-                current_app.logger.error(msg)
+                attempts = max(i.attempts for i in items) + 1
+                backoff = min(30 * 2 ** attempts, self._outbox_max_backoff)
+                current_app.logger.error(f"discourse topic id {topic_id} post error "
+                                         f"(attempt {attempts}): {ex}")
+                await db.execute(DiscourseOutbox.update(
+                    attempts=attempts,
+                    error=str(ex),
+                    modified=datetime.now(),
+                    next_attempt=datetime.now() + timedelta(seconds=backoff)
+                ).where(DiscourseOutbox.uuid.in_(uuids)))
+                return
+            await db.execute(DiscourseOutbox.delete().where(DiscourseOutbox.uuid.in_(uuids)))
+
+        await asyncio.gather(*[_send(t, items) for t, items in by_topic.items()])
 
     async def new_post(self, topic_id: int, body: str):
         if len(body) < 6:
             raise Exception("Post too short")
 
-        url = f"https://{settings.DISCOURSE_DOMAIN}/posts"
-        timeout = aiohttp.ClientTimeout(total=4)
-
         data = {
             "raw": body,
             "topic_id": topic_id
         }
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, data=data, headers=self._headers) as response:
-                blob = await response.json()
-                topic_id = blob['topic_id']
-                return topic_id
+        blob = await self._request("POST", "/posts", auth=True, timeout=4, data=data)
+        if 'topic_id' not in blob:
+            raise Exception(json.dumps(blob.get('errors', blob)))
+        topic_id = blob['topic_id']
+        return topic_id
 
     async def new_topic(self, title: str, body: str, category: int = None):
         """Returns integer (topic_id) on success, dict on error"""
         if len(body) < 40:
             raise Exception("Post too short")
 
-        url = f"https://{settings.DISCOURSE_DOMAIN}/posts"
-        timeout = aiohttp.ClientTimeout(total=4)
-
         data = {
             "title": title,
             "raw": body
@@ -112,18 +304,21 @@ class Discourse:
         if isinstance(category, int) and category >= 0:
             data['category'] = category
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, data=data, headers=self._headers) as response:
-                blob = await response.json()
-                if 'topic_id' not in blob:
-                    return blob
-                topic_id = blob['topic_id']
-                return topic_id
-
-    async def get_comments(self, topic_id: int) -> List[DiscourseComment]:
-        post_ids = await self._posts_by_topic(topic_id)
-        if not post_ids:
+        blob = await self._request("POST", "/posts", auth=True, timeout=4, data=data)
+        if 'topic_id' not in blob:
+            return blob
+        topic_id = blob['topic_id']
+        return topic_id
+
+    async def get_comments(self, topic_id: int, topic: dict = None,
+                           known: List[DiscourseComment] = None) -> List[DiscourseComment]:
+        """The last `DISCOURSE_MAX_COMMENTS_PER_TOPIC` posts of a topic. Posts
+        in `known` are reused, except for those embedded in the topic JSON."""
+        topic = topic or await self._topic(topic_id)
+        if not topic:
             return []
+        post_stream = topic['post_stream']
+        post_ids = post_stream['stream']
 
         # fetch last X comments
         per_topic = settings.DISCOURSE_MAX_COMMENTS_PER_TOPIC
@@ -133,46 +328,73 @@ class Discourse:
         if not post_ids:
             return []
 
-        posts = []
-        for p in post_ids:
-            res = await self._get_post(post_id=p)
-            posts.append(res)
+        comments = {c.post_id: c for c in known or [] if c.post_id}
+        for post in post_stream.get('posts', []):
+            if 'raw' in post:
+                comments[post['id']] = self._to_comment(post)
 
-        return [p for p in posts if isinstance(p, DiscourseComment) and p.author != settings.DISCOURSE_USERNAME]
+        # the topic embeds its first posts; get the rest in bulk, and only
+        # fall back to single requests for what the bulk calls left out
+        missing = [i for i in post_ids if i not in comments]
+        for blob in await self._get_posts(topic_id, missing):
+            comments[blob['id']] = self._to_comment(blob)
 
-    @safu
-    async def _posts_by_topic(self, topic_id: int):
-        url = f"https://{settings.DISCOURSE_DOMAIN}/t/{topic_id}.json"
-        timeout = aiohttp.ClientTimeout(total=5)
+        missing = [i for i in post_ids if i not in comments]
+        singles = await asyncio.gather(*[self._get_post(post_id=i) for i in missing])
+        comments.update({i: self._to_comment(blob) for i, blob in zip(missing, singles) if blob})
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=self._headers_no_auth) as resp:
-                blob = await resp.json()
-                return blob['post_stream']['stream']
+        return [comments[i] for i in post_ids if i in comments]
 
     @safu
-    async def _get_post(self, post_id: int) -> Optional[DiscourseComment]:
-        await self._semaphore.acquire()
-
-        url = f"https://{settings.DISCOURSE_DOMAIN}/posts/{post_id}.json"
-        timeout = aiohttp.ClientTimeout(total=5)
+    async def _topic(self, topic_id: int) -> dict:
+        return await self._request("GET", f"/t/{topic_id}.json", params={"include_raw": "true"})
+
+    async def _get_posts(self, topic_id: int, post_ids: List[int], chunk: int = 20,
+                         raw: bool = True) -> List[dict]:
+        """Bulk fetches posts of a topic, `chunk` per request"""
+        async def _chunk(ids: List[int]) -> List[dict]:
+            params = [("post_ids[]", i) for i in ids]
+            if raw:
+                params.append(("include_raw", "true"))
+            try:
+                blob = await self._request("GET", f"/t/{topic_id}/posts.json", params=params)
+                return [p for p in blob['post_stream']['posts'] if 'raw' in p or not raw]
+            except Exception as ex:
+                current_app.logger.error(f"discourse topic id {topic_id} bulk posts error: {ex}")
+                return []
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, headers=self._headers_no_auth) as resp:
-                blob = await resp.json()
-                if 'errors' in blob:
-                    current_app.logger.error(json.dumps(blob['errors']))
-                    return
+        chunks = [post_ids[i:i + chunk] for i in range(0, len(post_ids), chunk)]
+        return [p for res in await asyncio.gather(*[_chunk(c) for c in chunks]) for p in res]
 
-                result = DiscourseComment(
-                    author=blob['username'],
-                    markdown=blob['raw'],
-                    html=blob['cooked'],
-                    created_at=blob['created_at'],
-                    updated_at=blob['updated_at'],
-                    topic_id=blob['topic_id'],
-                    avatar_template=blob['avatar_template']
-                )
-
-        self._semaphore.release()
-        return result
+    @safu
+    async def _get_post(self, post_id: int) -> Optional[dict]:
+        blob = await self._request("GET", f"/posts/{post_id}.json")
+        if 'errors' in blob:
+            current_app.logger.error(json.dumps(blob['errors']))
+            return
+        return blob
+
+    @staticmethod
+    def _to_comment(blob: dict) -> DiscourseComment:
+        from funding.utils.markdown import generate_html
+        return DiscourseComment(
+            author=blob['username'],
+            markdown=blob['raw'],
+            html=blob['cooked'],
+            created_at=blob['created_at'],
+            updated_at=blob['updated_at'],
+            topic_id=blob['topic_id'],
+            avatar_template=blob['avatar_template'],
+            post_id=blob['id'],
+            post_number=blob.get('post_number', 0),
+            rendered=str(generate_html(blob['raw']))
+        )
+
+    async def _request(self, method: str, path: str, auth: bool = False, timeout: int = 5, **kwargs) -> dict:
+        url = f"https://{settings.DISCOURSE_DOMAIN}{path}"
+        headers = self._headers if auth else self._headers_no_auth
+        async with self._semaphore:
+            async with self.session.request(method, url, headers=headers,
+                                            timeout=aiohttp.ClientTimeout(total=timeout),
+                                            **kwargs) as resp:
+                return await resp.json()
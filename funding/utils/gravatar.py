@@ -1,25 +1,117 @@
 import asyncio
+import hashlib
 import os
+import re
+from io import BytesIO
+from typing import Dict, Optional, Tuple
 
 import aiohttp
-import aiofiles
-
-GRAVATAR_LOCK = asyncio.Lock()
-
-
-async def gravatar_download(hash: str, save_to_dir: str, filename: str) -> str:
-    """Download image, save to disk, return abs. path"""
-    dest = os.path.join(save_to_dir, filename)
-    url = f'https://www.gravatar.com/avatar/{hash}'
-    async with GRAVATAR_LOCK:
-        timeout = aiohttp.ClientTimeout(connect=3, total=5)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url) as resp:
-                content_type = resp.headers.get('content-type')
-                if not content_type.startswith("image"):
-                    raise Exception("gravatar failure")
-
-                data: bytes = await resp.content.read()
-                async with aiofiles.open(dest, mode='wb') as f:
-                    await f.write(data)
-        return dest
+from quart import current_app
+
+import settings
+
+
+def _thumbnails(data: bytes, dest: str, sizes: Tuple[int, ...]):
+    """Writes `data` resized to each of `sizes` to `dest.format(size=...)`"""
+    from PIL import Image
+    im = Image.open(BytesIO(data)).convert("RGBA")
+    for size in sizes:
+        path = dest.format(size=size)
+        im.resize((size, size), Image.LANCZOS).save(path + ".tmp", format="PNG", optimize=True)
+        os.replace(path + ".tmp", path)
+
+
+class Gravatar:
+    """Downloads gravatar images over one shared keep-alive session, at
+    most `_max_concurrency` at a time, and stores them as thumbnails in
+    `data/gravatar`. Concurrent requests for the same hash share a
+    download; failures are remembered for `_miss_expiry`."""
+    sizes = (32, 64, 128)
+
+    def __init__(self):
+        self._max_concurrency = 4
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._miss_expiry = 3600
+        self.base = os.path.join(settings.cwd, 'data', 'gravatar')
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(connect=3, total=5)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    @staticmethod
+    def valid_hash(hash: str) -> bool:
+        return bool(hash and re.fullmatch(r"[0-9a-f]{32}", hash))
+
+    def path(self, hash: str, size: int) -> str:
+        return os.path.join(self.base, f"{hash}_{size}.png")
+
+    def size(self, size: Optional[int]) -> int:
+        """Smallest stored size that is at least `size`"""
+        return next((s for s in self.sizes if size and s >= size), self.sizes[-1])
+
+    async def avatar(self, hash: str, size: int = None) -> str:
+        """Path to the thumbnail of `hash`, fetching it if needed"""
+        if not self.valid_hash(hash):
+            raise Exception("invalid gravatar hash")
+
+        path = self.path(hash, self.size(size))
+        if os.path.exists(path):
+            return path
+
+        cache = current_app.session_interface
+        if await cache.get(f"gravatar_miss_{hash}"):
+            raise Exception("gravatar failure (cached)")
+
+        fut = self._inflight.get(hash)
+        if fut is None:
+            fut = asyncio.ensure_future(self._download(hash))
+            self._inflight[hash] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(hash, None))
+        await asyncio.shield(fut)
+        return path
+
+    async def warmup(self) -> int:
+        """Fetches the avatars of all users that are not stored yet"""
+        from funding.factory import db
+        from funding.models.database import User
+        mails = await db.execute(User.select(User.mail).where(User.mail.is_null(False)).distinct())
+        hashes = {hashlib.md5(u.mail.encode()).hexdigest() for u in mails if u.mail}
+
+        async def _fetch(hash: str) -> bool:
+            try:
+                await self.avatar(hash)
+                return True
+            except Exception as ex:
+                current_app.logger.error(f"Unable to fetch gravatar image {hash}: {ex}")
+                return False
+
+        return sum(await asyncio.gather(*[_fetch(h) for h in hashes]))
+
+    async def _download(self, hash: str):
+        from funding.factory import images
+        url = f'https://www.gravatar.com/avatar/{hash}?s={self.sizes[-1]}'
+        try:
+            async with self._semaphore:
+                async with self.session.get(url) as resp:
+                    content_type = resp.headers.get('content-type', '')
+                    if resp.status != 200 or not content_type.startswith("image"):
+                        raise Exception("gravatar failure")
+                    data: bytes = await resp.read()
+        except Exception:
+            cache = current_app.session_interface
+            await cache.set(f"gravatar_miss_{hash}", "1", expiry=self._miss_expiry)
+            raise
+
+        os.makedirs(self.base, exist_ok=True)
+        dest = os.path.join(self.base, f"{hash}_{{size}}.png")
+        await images.run(_thumbnails, data, dest, self.sizes)
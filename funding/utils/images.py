@@ -0,0 +1,140 @@
+import asyncio
+import os
+from uuid import uuid4
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple, Set
+
+import aiofiles
+from quart import current_app
+
+import settings
+
+
+def _render_qr(address: str, dest: str) -> str:
+    from funding.utils.qr import QrCodeGenerator
+    qr = QrCodeGenerator()
+    qr.render(address).save(dest, **qr.pil_save_options)
+    return dest
+
+
+_captcha = None
+
+
+def _render_captcha(secret: str) -> bytes:
+    # one instance per process, so the font is only loaded once
+    global _captcha
+    if _captcha is None:
+        from funding.utils.captcha import FundingCaptcha
+        _captcha = FundingCaptcha(fonts=[settings.CAPTCHA_TTF])
+    return _captcha.generate(secret).getvalue()
+
+
+class ImageService:
+    """Runs CPU-bound image rendering in a process pool, off the event
+    loop. Concurrent requests for the same image share one render."""
+    def __init__(self, max_workers: int = None):
+        self._max_workers = max_workers or min(os.cpu_count() or 1, 4)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._background: Set[asyncio.Future] = set()
+
+        # address -> (png, etag), most recently used last
+        self._qr_cache: OrderedDict[str, Tuple[bytes, str]] = OrderedDict()
+        self._qr_cache_size = 512
+        self._qr_dir = os.path.join(settings.cwd, 'funding', 'static', 'qr')
+
+        # pre-rendered (secret, image) captchas
+        self._captcha_pool_size = 32
+        self._captchas: Optional[asyncio.Queue] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def once(self, key: str, func, *args):
+        """`run`, but callers passing the same `key` while a render is in
+        flight wait for that render instead of starting another"""
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(self.run(func, *args))
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(fut)
+
+    async def qr(self, address: str, render: bool = True) -> Optional[Tuple[bytes, str]]:
+        """PNG and ETag of the QR image of an address, from memory, then
+        disk, rendering it if needed (and `render`)"""
+        from funding.utils import validate_crypto_address
+        if not address.isalnum() or not validate_crypto_address(address):
+            raise Exception('faulty address')
+
+        hit = self._qr_cache.get(address)
+        if hit:
+            self._qr_cache.move_to_end(address)
+            return hit
+
+        dest = os.path.join(self._qr_dir, f'{address}.png')
+        try:
+            data = await self._read(dest)
+        except FileNotFoundError:
+            if not render:
+                return
+            os.makedirs(self._qr_dir, exist_ok=True)
+            await self.once(f"qr_{address}", _render_qr, address, dest)
+            data = await self._read(dest)
+
+        hit = self._qr_cache[address] = (data, hashlib.sha1(data).hexdigest())
+        while len(self._qr_cache) > self._qr_cache_size:
+            self._qr_cache.popitem(last=False)
+        return hit
+
+    def pregenerate_qr(self, address: str):
+        """Renders the QR image of an address in the background"""
+        fut = asyncio.ensure_future(self.qr(address))
+        self._background.add(fut)
+        fut.add_done_callback(self._background.discard)
+
+    @staticmethod
+    async def _read(path: str) -> bytes:
+        async with aiofiles.open(path, mode='rb') as f:
+            return await f.read()
+
+    @property
+    def captchas(self) -> asyncio.Queue:
+        if self._captchas is None:
+            self._captchas = asyncio.Queue(maxsize=self._captcha_pool_size)
+        return self._captchas
+
+    async def captcha_task(self):
+        """Keeps the captcha pool filled"""
+        while True:
+            try:
+                await self.captchas.put(await self._new_captcha())
+            except Exception as ex:
+                current_app.logger.error(f"captcha render error: {ex}")
+                await asyncio.sleep(10)
+
+    async def captcha(self) -> Tuple[str, bytes]:
+        """A ready (secret, image) pair from the pool, rendering one only
+        when the pool ran dry"""
+        try:
+            return self.captchas.get_nowait()
+        except asyncio.QueueEmpty:
+            return await self._new_captcha()
+
+    async def _new_captcha(self) -> Tuple[str, bytes]:
+        secret = uuid4().hex[:4]
+        return secret, await self.run(_render_captcha, secret)
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import time
+from uuid import uuid4
+from datetime import datetime
+from typing import List, Dict, Tuple, Optional
+
+import aiohttp
+from aiocryptocurrency.coins import TransactionSet
+from aiocryptocurrency.coins.nero import Nero
+from quart import current_app
+
+from funding.utils import safu
+
+
+class Ledger:
+    """Syncs incoming transfers for donation addresses from the wallet RPC
+    into Postgres (`Deposit`), only asking for blocks above the last
+    height (or block hash) seen, and bumps the funding totals on
+    `Proposal`. One worker at a time holds the `ledger_syncer` lock in
+    Redis and syncs. Keeps an in-process index of the stored transfers
+    per address."""
+    def __init__(self, expiry: int = 60):
+        self._min_confirmations = 3
+        self._expiry = expiry
+        self._index: Dict[Tuple[str, Optional[str]], Tuple[float, TransactionSet]] = {}
+        self.height: int = 0
+        self._id = uuid4().hex
+        self._lock_key = "ledger_syncer"
+
+    async def ledger_task(self):
+        while True:
+            await self._ledger_task()
+            await asyncio.sleep(self._expiry)
+
+    @safu
+    async def _ledger_task(self):
+        from funding.factory import db
+        from funding.models.database import Proposal, ProposalStatus
+
+        # elect a single syncer among all workers
+        cache = current_app.session_interface
+        if not await cache.backend.set(self._lock_key, self._id, ex=self._expiry, nx=True):
+            self.height = await self._load('ledger_height', self.height)
+            return
+
+        q: List[Proposal] = await db.execute(Proposal.select().filter(
+            Proposal.crypto_address_donation.is_null(False),
+            Proposal.status.in_([ProposalStatus.funding_required, ProposalStatus.wip])))
+        await self.sync([(p.crypto_address_donation, p.crypto_address_payment_id) for p in q])
+
+    def get(self, address: str, payment_id: str = None) -> Optional[TransactionSet]:
+        """Returns the indexed transfers for an address, if still fresh"""
+        hit = self._index.get((address, payment_id))
+        if not hit:
+            return
+        date, txs = hit
+        if time.time() - date > self._expiry:
+            return
+        return txs
+
+    def set(self, address: str, payment_id: str, txs: TransactionSet):
+        self._index[(address, payment_id)] = (time.time(), txs)
+
+    async def sync(self, keys: List[Tuple[str, Optional[str]]]):
+        """Fetches new incoming transfers for the given addresses and stores them"""
+        from funding.factory import crypto_provider, db, api_cache
+        from funding.models.database import Deposit, Proposal
+        keys = set(keys)
+        if not keys:
+            return
+
+        # the wallet height last synced at, minus what was not yet confirmed
+        tip = await self._load('ledger_height', 0)
+        if isinstance(crypto_provider, Nero):
+            rows, height, checkpoint = await self._sync_nero(keys, max(tip - self._min_confirmations - 1, 0))
+        else:
+            rows, height, checkpoint = await self._sync_firo(keys)
+
+        if rows:
+            totals: Dict[str, Tuple[float, int]] = {}
+            async with db.atomic():
+                inserted = await db.execute(Deposit.insert_many(rows).on_conflict_ignore()
+                                            .returning(Deposit.address, Deposit.amount).tuples())
+                for address, amount in inserted:
+                    raised, count = totals.get(address, (0.0, 0))
+                    totals[address] = (raised + amount, count + 1)
+                for address, (raised, count) in totals.items():
+                    await Proposal.add_funds_raised(address, raised, count)
+
+            # only after commit, so no request caches the old totals as current
+            if totals:
+                await api_cache.invalidate()
+
+            for row in rows:
+                self._index.pop((row['address'], row['payment_id']), None)
+
+        self.height = max(tip, height)
+        for name, value in {'ledger_height': self.height, **checkpoint}.items():
+            await self._save(name, value)
+
+    async def _sync_nero(self, keys, height_from: int) -> Tuple[List[dict], int, dict]:
+        """One `get_bulk_payments` call for all payment ids above `height_from`"""
+        from funding.factory import crypto_provider
+        height = (await self._rpc("get_height"))['height']
+        by_payment_id = {payment_id: address for address, payment_id in keys if payment_id}
+        if not by_payment_id:
+            return [], height, {}
+
+        result = await self._rpc("get_bulk_payments", {
+            "payment_ids": list(by_payment_id),
+            "min_block_height": height_from
+        })
+
+        rows = []
+        for payment in result.get('payments', []):
+            address = by_payment_id.get(payment['payment_id'])
+            confirmations = height - payment['block_height']
+            if not address or confirmations < self._min_confirmations:
+                continue
+            rows.append(dict(
+                txid=payment['tx_hash'],
+                address=address,
+                payment_id=payment['payment_id'],
+                amount=float(payment['amount']) / crypto_provider._div,
+                blockheight=payment['block_height'],
+                confirmations=confirmations,
+                date=datetime.now()))
+        return rows, height, {}
+
+    async def _sync_firo(self, keys) -> Tuple[List[dict], int, dict]:
+        """One `listsinceblock` call for the blocks after the last block hash
+        seen; that hash is `_min_confirmations` deep, so transfers skipped as
+        unconfirmed are listed again by the next call"""
+        addresses = {address: payment_id for address, payment_id in keys}
+        block = await self._load('ledger_block', "")
+
+        tip = await self._rpc("getblockcount")
+        result = await self._rpc("listsinceblock", [block, self._min_confirmations])
+
+        # a transaction may pay an address with several outputs
+        received: Dict[Tuple[str, str], dict] = {}
+        for entry in result.get('transactions', []):
+            address = entry.get('address')
+            if entry.get('category') != 'receive' or address not in addresses:
+                continue
+            if entry['confirmations'] < self._min_confirmations:
+                continue
+            row = received.get((entry['txid'], address))
+            if row:
+                row['amount'] += entry['amount']
+                continue
+            received[(entry['txid'], address)] = dict(
+                txid=entry['txid'],
+                address=address,
+                payment_id=None,
+                amount=entry['amount'],
+                blockheight=tip - entry['confirmations'] + 1,
+                confirmations=entry['confirmations'],
+                date=datetime.fromtimestamp(entry['blocktime']))
+        return list(received.values()), tip + 1, {'ledger_block': result['lastblock']}
+
+    async def _rpc(self, method: str, params=None):
+        from funding.factory import crypto_provider
+        await crypto_provider._generate_url()
+
+        data = {"jsonrpc": "2.0", "id": "0", "method": method}
+        if params is not None:
+            data['params'] = params
+
+        opts = {
+            "headers": {"User-Agent": crypto_provider.user_agent},
+            "timeout": aiohttp.ClientTimeout(total=30)
+        }
+        if crypto_provider.basic_auth:
+            opts['auth'] = await crypto_provider._make_basic_auth()
+
+        async with aiohttp.ClientSession(**opts) as session:
+            async with session.post(crypto_provider.url, json=data) as resp:
+                if resp.status == 401:
+                    raise Exception("Unauthorized")
+                blob = await resp.json(content_type=None)
+                if 'result' not in blob or blob.get('error'):
+                    raise Exception(f"Invalid response: {json.dumps(blob)}")
+                return blob['result']
+
+    @staticmethod
+    async def _load(name: str, default=None):
+        from funding.factory import db
+        from funding.models.database import System
+        try:
+            return (await db.get(System, name=name)).value
+        except Exception:
+            return default
+
+    @staticmethod
+    async def _save(name: str, value):
+        from funding.factory import db
+        from funding.models.database import System
+        updated = await db.execute(System.update(value=value, modified=datetime.now())
+                                   .where(System.name == name))
+        if not updated:
+            await System.create_async(name=name, value=value)
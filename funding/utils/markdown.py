@@ -12,6 +12,10 @@ import html
 import mistletoe as m
 from mistletoe.span_token import SpanToken, RawText
 import re
+import json
+import hashlib
+from collections import Counter, OrderedDict
+from typing import Optional
 
 
 MARKDOWN_PROPOSAL_DEFAULT = """
@@ -230,7 +234,104 @@ def add_noopener(html):
     return str(soup)
 
 
-def generate_html(markdown, baselevel=1, link_prefix=None, with_styles=True) -> str:
+class RenderCache:
+    """LRU of rendered markdown keyed by a hash of the markdown and the
+    render options, bounded by the total length of the stored HTML and
+    optionally backed by Redis (`MARKDOWN_CACHE_REDIS`)."""
+    def __init__(self, max_size: int = 16 * 1024 * 1024, expiry: int = 86400):
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._max_size = max_size
+        self._size = 0
+        self._expiry = expiry
+        self.stats = Counter()
+
+    @staticmethod
+    def key(markdown, *options) -> str:
+        blob = json.dumps([markdown, *options])
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        html = self._entries.get(key)
+        if html is not None:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return html
+
+    def set(self, key: str, html: str):
+        if len(html) > self._max_size:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = html
+        self._size += len(html)
+        while self._size > self._max_size:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old)
+
+    async def get_redis(self, key: str) -> Optional[str]:
+        from quart import current_app
+        html = await current_app.session_interface.get(f"markdown_{key}")
+        if html:
+            self.stats["redis_hits"] += 1
+            self.set(key, html)
+            return html
+
+    async def set_redis(self, key: str, html: str):
+        from quart import current_app
+        await current_app.session_interface.set(f"markdown_{key}", html, expiry=self._expiry)
+
+    def hit_rate(self) -> float:
+        total = sum(self.stats.values())
+        if not total:
+            return 0.0
+        return round((self.stats["hits"] + self.stats["redis_hits"]) / total, 4)
+
+    def to_json(self) -> dict:
+        return {
+            **self.stats,
+            "hit_rate": self.hit_rate(),
+            "entries": len(self._entries),
+            "size": self._size
+        }
+
+
+RENDER_CACHE = RenderCache()
+
+# live previews change with every keystroke; kept apart so they do not
+# push proposal and comment renders out of `RENDER_CACHE`
+PREVIEW_CACHE = RenderCache(max_size=2 * 1024 * 1024)
+
+
+def generate_html(markdown, baselevel=1, link_prefix=None, with_styles=True,
+                  cache: RenderCache = RENDER_CACHE) -> str:
+    key = cache.key(markdown, baselevel, link_prefix, with_styles)
+    html = cache.get(key)
+    if html is None:
+        cache.stats["misses"] += 1
+        html = _generate_html(markdown, baselevel, link_prefix, with_styles)
+        cache.set(key, html)
+    return Markup(html)
+
+
+async def generate_html_async(markdown, baselevel=1, link_prefix=None, with_styles=True,
+                              cache: RenderCache = RENDER_CACHE) -> str:
+    """`generate_html`, also consulting the Redis tier if enabled"""
+    import settings
+    if not settings.MARKDOWN_CACHE_REDIS:
+        return generate_html(markdown, baselevel, link_prefix, with_styles, cache=cache)
+
+    key = cache.key(markdown, baselevel, link_prefix, with_styles)
+    html = cache.get(key) or await cache.get_redis(key)
+    if html is None:
+        cache.stats["misses"] += 1
+        html = _generate_html(markdown, baselevel, link_prefix, with_styles)
+        cache.set(key, html)
+        await cache.set_redis(key, html)
+    return Markup(html)
+
+
+def _generate_html(markdown, baselevel=1, link_prefix=None, with_styles=True) -> str:
     with SrhtRenderer(link_prefix, baselevel) as renderer:
         html = renderer.render(m.Document(markdown))
     formatter = HtmlFormatter()
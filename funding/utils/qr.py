@@ -1,5 +1,5 @@
-import asyncio
 import os
+import timeit
 from io import BytesIO
 
 import pyqrcode
@@ -8,13 +8,12 @@ from PIL import Image, ImageDraw
 from funding.utils import validate_crypto_address
 import settings
 
-QR_LOCK = asyncio.Lock()
-
 
 class QrCodeGenerator:
     def __init__(self):
         self.base = os.path.join(settings.cwd, 'funding', 'static', 'qr')
         self.image_size = (300, 300)
+        self.quiet_zone = 2
         self.pil_save_options = {
             'quality': 25,
             'optimize': True
@@ -46,6 +45,43 @@ class QrCodeGenerator:
         if not dest:
             dest = os.path.join(self.base, f'{address}.png')
 
+        im = self.render(address, color_from, color_to)
+        im.save(dest, **self.pil_save_options)
+        return dest
+
+    def render(self, address, color_from=(170,43,43), color_to=(230,51,51)) -> Image.Image:
+        """
+        Renders the QR matrix straight to `image_size` with whole-image
+        operations: light modules are opaque white, dark modules show the
+        diagonal gradient (or black, without colors).
+        """
+        code = pyqrcode.create(address, error='L').code
+        n = len(code) + self.quiet_zone * 2
+        pad = bytes([255]) * self.quiet_zone
+        rows = [pad + bytes(0 if bit else 255 for bit in row) + pad for row in code]
+        blank = bytes([255]) * n
+        modules = b"".join([blank] * self.quiet_zone + rows + [blank] * self.quiet_zone)
+
+        mask = Image.frombytes('L', (n, n), modules).resize(self.image_size, Image.NEAREST)
+
+        if not color_from and not color_to:
+            return Image.merge('RGBA', (mask, mask, mask, Image.new('L', self.image_size, 255)))
+
+        im = Image.new('RGBA', self.image_size, (255, 255, 255, 255))
+        im.putalpha(mask)
+
+        # one row holding the gradient, sheared so that pixel (x, y) takes
+        # the color at x + y, as the anti-diagonal lines did
+        width, height = self.image_size
+        strip = Image.new('RGBA', (width + height, 1))
+        strip.putdata([(*c, 255) for c in self.gradient_interpolate(color_from, color_to, width + height)])
+        gradient = strip.resize((width + height, height), Image.NEAREST) \
+            .transform(self.image_size, Image.AFFINE, (1, 1, 0, 0, 1, 0), resample=Image.NEAREST)
+
+        return Image.alpha_composite(gradient, im)
+
+    def _render_legacy(self, address, color_from=(170,43,43), color_to=(230,51,51)) -> Image.Image:
+        """The previous per-pixel renderer, kept for `benchmark`"""
         created = pyqrcode.create(address, error='L')
         buffer = BytesIO()
         created.png(buffer, scale=14, quiet_zone=2)
@@ -54,24 +90,17 @@ class QrCodeGenerator:
         im = im.convert("RGBA")
         im.thumbnail(self.image_size)
 
-        im_data = im.getdata()
-
-        # make black color transparent
         im_transparent = []
-        for color_point in im_data:
+        for color_point in im.getdata():
             if sum(color_point[:3]) == 255 * 3:
                 im_transparent.append(color_point)
             else:
-                # get rid of the subtle grey borders
                 alpha = 0 if color_from and color_to else 1
                 im_transparent.append((0, 0, 0, alpha))
-                continue
 
         if not color_from and not color_to:
-            im.save(dest, **self.pil_save_options)
-            return dest
+            return im
 
-        # turn QR into a gradient
         im.putdata(im_transparent)
 
         gradient = Image.new('RGBA', im.size, color=0)
@@ -80,13 +109,24 @@ class QrCodeGenerator:
         for i, color in enumerate(QrCodeGenerator.gradient_interpolate(color_from, color_to, im.width * 2)):
             draw.line([(i, 0), (0, i)], tuple(color), width=1)
 
-        im_gradient = Image.alpha_composite(gradient, im)
-        im_gradient.save(dest, **self.pil_save_options)
+        return Image.alpha_composite(gradient, im)
 
-        return dest
+    def benchmark(self, address, number=20) -> dict:
+        """Average seconds per render for both renderers"""
+        return {
+            name: timeit.timeit(lambda: func(address), number=number) / number
+            for name, func in [("render", self.render), ("legacy", self._render_legacy)]
+        }
 
     @staticmethod
     def gradient_interpolate(color_from, color_to, interval):
         det_co = [(t - f) / interval for f, t in zip(color_from, color_to)]
         for i in range(interval):
             yield [round(f + det * i) for f, det in zip(color_from, det_co)]
+
+
+if __name__ == '__main__':
+    import sys
+    address = sys.argv[1] if len(sys.argv) > 1 else "a" * 95
+    for name, secs in QrCodeGenerator().benchmark(address).items():
+        print(f"{name}: {secs * 1000:.2f}ms")
@@ -1,5 +1,8 @@
 import asyncio
 import json
+import time
+from uuid import uuid4
+from typing import Dict, List
 
 import aiohttp
 from quart import current_app
@@ -9,46 +12,112 @@ from funding.utils.http.agents import random_agent
 from funding.utils import safu
 
 
+class CoinGeckoProvider:
+    """All coins and currencies in one `simple/price` call"""
+    url = "https://api.coingecko.com/api/v3/simple/price"
+
+    async def fetch(self, coins: List[str], currencies: List[str]) -> Dict[str, Dict[str, float]]:
+        params = {"ids": ",".join(coins), "vs_currencies": ",".join(currencies)}
+        ua = random_agent()
+        timeout = aiohttp.ClientTimeout(total=5)
+
+        async with aiohttp.ClientSession(headers={"User-Agent": ua}, timeout=timeout) as session:
+            async with session.get(self.url, params=params) as resp:
+                data = await resp.json()
+                try:
+                    return {cgid: {cur: float(data[cgid][cur]) for cur in currencies if cur in data[cgid]}
+                            for cgid in coins if cgid in data}
+                except Exception:
+                    raise Exception(f"Could not parse JSON response; {json.dumps(data)}")
+
+
+class StaticProvider:
+    """Fixed rates, for running without network access"""
+    def __init__(self, rate: float = 1.0):
+        self.rate = rate
+
+    async def fetch(self, coins: List[str], currencies: List[str]) -> Dict[str, Dict[str, float]]:
+        return {cgid: {cur: self.rate for cur in currencies} for cgid in coins}
+
+
+RATE_PROVIDERS = {
+    "coingecko": CoinGeckoProvider,
+    "static": StaticProvider
+}
+
+
 class Rates:
+    """Fiat rates for all known coins. One worker at a time holds the
+    `rates_fetcher` lock in Redis and publishes a snapshot there; every
+    worker reads the snapshot into `self.rates`."""
     def __init__(self):
-        self.rate: float = 0.0
+        self.rates: Dict[str, Dict[str, float]] = {}
+        self._id = uuid4().hex
+        self._interval = 600
+        self._refresh = 60
+        self._lock_key = "rates_fetcher"
+        self._snapshot_key = "rates_snapshot"
+
+    @property
+    def rate(self) -> float:
+        """USD rate of the configured coin"""
+        return self.get()
+
+    def get(self, currency: str = "usd", coin: str = None) -> float:
+        from funding.factory import coin as _coin
+        cgid = coin or _coin['coingecko_id']
+        return self.rates.get(cgid, {}).get(currency, 0.0)
 
     async def rate_task(self):
         while True:
-            if await self._rate_task():
-                current_app.logger.info("Fetched USD rate")
-            else:
-                current_app.logger.error("Failed to fetch USD rate; retrying in 10 minutes")
-            await asyncio.sleep(600)
-
-    async def to_usd(self, amount: float):
-        if self.rate == 0:
+            await self._rate_task()
+            await asyncio.sleep(self._refresh)
+
+    def to_usd(self, amount: float) -> float:
+        return self.to_fiat(amount, "usd")
+
+    def to_fiat(self, amount: float, currency: str) -> float:
+        """Converts an amount of the configured coin using the in-memory rates"""
+        rate = self.get(currency)
+        if rate == 0 or not amount:
             return 0
-        return round(self.rate * amount, 2)
+        return round(rate * amount, 2)
 
     @safu
     async def _rate_task(self):
-        from funding.factory import coin
+        cache = current_app.session_interface
+        snapshot = await cache.get(self._snapshot_key)
+        if snapshot:
+            snapshot = json.loads(snapshot)
+            self.rates = snapshot['rates']
+            if time.time() - snapshot['date'] < self._interval:
+                return
 
-        cgid = coin['coingecko_id']
-        cache_key = f"usd_rate_{cgid}"
+        # elect a single fetcher among all workers
+        if not await cache.backend.set(self._lock_key, self._id, ex=self._interval, nx=True):
+            return
 
-        cache = current_app.session_interface
-        result = await cache.get(cache_key)
-        if result:
-            result = json.loads(result)
-            self.rate = result
+        if await self.fetch():
+            current_app.logger.info(f"Fetched rates for {', '.join(settings.RATES_CURRENCIES)}")
+        else:
+            current_app.logger.error("Failed to fetch rates; retrying in 10 minutes")
 
-        url = f"https://api.coingecko.com/api/v3/simple/price?ids={cgid}&vs_currencies=usd"
-        ua = random_agent()
-        timeout = aiohttp.ClientTimeout(total=5)
+    async def fetch(self) -> Dict[str, Dict[str, float]]:
+        """Fetches rates from the configured provider and publishes them"""
+        from funding.utils.globals import COINS_LOOKUP
+        provider = RATE_PROVIDERS[settings.RATES_PROVIDER]()
+        coins = sorted({c['coingecko_id'] for c in COINS_LOOKUP.values()})
 
-        async with aiohttp.ClientSession(headers={"User-Agent": ua}, timeout=timeout) as session:
-            async with session.get(url) as resp:
-                data = await resp.json()
-                try:
-                    self.rate = data[cgid]['usd']
-                    return self.rate
-                except Exception as ex:
-                    data = json.dumps(data)
-                    current_app.logger.error(f"Could not parse JSON response; {data}")
+        try:
+            rates = await provider.fetch(coins, settings.RATES_CURRENCIES)
+        except Exception as ex:
+            current_app.logger.error(f"rates provider {settings.RATES_PROVIDER} error: {ex}")
+            return {}
+        if not rates:
+            return {}
+
+        self.rates = rates
+        cache = current_app.session_interface
+        await cache.set(self._snapshot_key, json.dumps({"date": time.time(), "rates": rates}),
+                        expiry=self._interval * 6)
+        return rates
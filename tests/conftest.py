@@ -0,0 +1,16 @@
+import os
+import sys
+import types
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# fall back to the example settings when no `settings.py` was configured
+try:
+    import settings
+except ImportError:
+    settings = types.ModuleType("settings")
+    settings.__file__ = os.path.join(root, "settings.py")
+    with open(os.path.join(root, "settings.py_example")) as f:
+        exec(f.read(), settings.__dict__)
+    sys.modules["settings"] = settings
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from quart import Quart
+
+import settings
+from funding.utils.discourse import Discourse
+
+
+class MemoryCache:
+    """Stand-in for the Redis session interface"""
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, val, expiry=None):
+        self.data[key] = val
+
+
+class FakeForum:
+    """A topic of `count` posts, of which the topic JSON embeds the first 20"""
+    def __init__(self, count: int):
+        self.posts = {i: self.post(i, "2020-01-01T00:00:00.000Z") for i in range(1, count + 1)}
+        self.requests = []
+
+    @staticmethod
+    def post(i: int, updated_at: str) -> dict:
+        return {"id": i, "post_number": i, "topic_id": 1, "username": "someone", "raw": f"post {i}",
+                "cooked": f"<p>post {i}</p>", "created_at": "2020-01-01T00:00:00.000Z",
+                "updated_at": updated_at, "avatar_template": "/a/{size}.png"}
+
+    def edit(self, i: int):
+        self.posts[i] = {**self.post(i, "2020-02-01T00:00:00.000Z"), "raw": f"post {i} edited"}
+
+    async def request(self, method, path, params=None, **kwargs):
+        self.requests.append((path, params))
+        if path == "/t/1.json":
+            return {"highest_post_number": len(self.posts), "post_stream": {
+                "stream": list(self.posts), "posts": [self.posts[i] for i in list(self.posts)[:20]]}}
+        ids = [v for k, v in params if k == "post_ids[]"]
+        raw = ("include_raw", "true") in params
+        return {"post_stream": {"posts": [
+            self.posts[i] if raw else {k: v for k, v in self.posts[i].items() if k != "raw"}
+            for i in ids]}}
+
+
+@pytest.fixture
+def forum(monkeypatch):
+    monkeypatch.setattr(settings, "DISCOURSE_MAX_COMMENTS_PER_TOPIC", 5)
+    return FakeForum(30)
+
+
+def test_edit_beyond_first_page(forum):
+    discourse = Discourse()
+    discourse._request = forum.request
+    proposal = SimpleNamespace(discourse_topic_id=1)
+    app = Quart(__name__)
+    app.session_interface = MemoryCache()
+
+    async def _run():
+        async with app.app_context():
+            await discourse._refresh_topic(proposal)
+            first = [c.post_id for c in await discourse._load_comments(1)]
+
+            # nothing changed: the topic and one bulk check, without raw
+            forum.requests.clear()
+            await discourse._refresh_topic(proposal)
+            unchanged = list(forum.requests)
+
+            forum.edit(28)
+            forum.requests.clear()
+            await discourse._refresh_topic(proposal)
+            comments = {c.post_id: c.markdown for c in await discourse._load_comments(1)}
+            return first, unchanged, list(forum.requests), comments
+
+    first, unchanged, edited, comments = asyncio.run(_run())
+    assert first == [26, 27, 28, 29, 30]
+    assert len(unchanged) == 2 and ("include_raw", "true") not in unchanged[1][1]
+    # only the edited post is fetched again
+    assert edited[-1][1] == [("post_ids[]", 28), ("include_raw", "true")]
+    assert comments[28] == "post 28 edited"
+    assert comments[27] == "post 27"
@@ -0,0 +1,25 @@
+from funding.utils.markdown import RenderCache, generate_html
+
+
+def test_size_bound():
+    cache = RenderCache(max_size=10)
+    cache.set("a", "x" * 4)
+    cache.set("b", "x" * 4)
+    assert cache.get("a")
+    cache.set("c", "x" * 4)
+    # least recently used goes first
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+
+    cache.set("d", "x" * 11)
+    assert cache.get("d") is None
+    assert cache.to_json()["size"] == 8
+
+
+def test_stats():
+    cache = RenderCache()
+    for _ in range(3):
+        html = generate_html("# hi", cache=cache)
+    assert "<h2" in html
+    assert cache.to_json() == {"misses": 1, "hits": 2, "hit_rate": 0.6667,
+                               "entries": 1, "size": len(html)}
@@ -0,0 +1,36 @@
+import asyncio
+
+from quart import Quart
+
+from funding.utils import memoized, invalidate_memo, MEMO_STATS
+
+
+class Thing:
+    def __init__(self, pk):
+        self._pk = pk
+        self.calls = 0
+
+    @memoized
+    async def value(self):
+        self.calls += 1
+        return self._pk
+
+
+def test_memoized():
+    app = Quart(__name__)
+    MEMO_STATS.clear()
+    a, b = Thing(1), Thing(2)
+
+    async def _run():
+        async with app.test_request_context("/"):
+            for _ in range(3):
+                assert await a.value() == 1
+            assert await b.value() == 2
+            invalidate_memo(a)
+            await a.value()
+        # outside a request nothing is memoized, nor counted
+        await a.value()
+    asyncio.run(_run())
+
+    assert (a.calls, b.calls) == (3, 1)
+    assert MEMO_STATS == {"value_fetched": 3, "value_saved": 2}
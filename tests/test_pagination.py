@@ -0,0 +1,26 @@
+import base64
+import json
+from datetime import datetime
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+from funding.models.utils import encode_cursor, decode_cursor
+
+
+def _cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def test_roundtrip():
+    obj = SimpleNamespace(created=datetime(2020, 1, 2, 3, 4, 5), _pk=uuid4())
+    assert decode_cursor(encode_cursor(obj)) == (obj.created, obj._pk)
+
+
+@pytest.mark.parametrize("cursor", [
+    "", "garbage", _cursor("2020-01-01T00:00:00", "1 OR 1=1"),
+    _cursor("yesterday", str(uuid4())), _cursor("2020-01-01T00:00:00"), _cursor(1, 2)
+])
+def test_invalid(cursor):
+    assert decode_cursor(cursor) is None
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from uuid import uuid4
+
+import pytest
+
+from funding.factory import database
+from funding.models.database import User, Proposal, Event, Withdrawal
+from funding.models.enums import ProposalStatus
+from funding.models.utils import assert_max_queries, paginate
+
+
+def test_assert_max_queries():
+    with assert_max_queries(2) as counter:
+        logging.getLogger('peewee').debug(("SELECT 1", ()))
+        logging.getLogger('peewee.async').debug(("SELECT 2", ()))
+    assert counter.count == 2
+
+    with pytest.raises(AssertionError, match="at most 1 queries, got 2"):
+        with assert_max_queries(1):
+            logging.getLogger('peewee').debug(("SELECT 1", ()))
+            logging.getLogger('peewee.async').debug(("SELECT 2", ()))
+
+
+def test_listing_sql():
+    sql, params = Proposal.listing(Proposal.status == ProposalStatus.wip).sql()
+    assert 'INNER JOIN "user"' in sql
+    assert '"t2"."username"' in sql
+
+    # fields narrow the selected columns, the join stays
+    sql, params = Proposal.listing(fields=[Proposal.title, User.username]).sql()
+    assert sql.startswith('SELECT "t1"."title", "t2"."username" FROM "proposal"')
+    assert 'INNER JOIN "user"' in sql
+
+
+def test_fetch_listing(monkeypatch):
+    import funding.models.database
+
+    class FakeManager:
+        def __init__(self):
+            self.calls = []
+
+        async def execute(self, query):
+            self.calls.append(("execute", query))
+            return []
+
+        async def prefetch(self, query, *subqueries):
+            self.calls.append(("prefetch", query, *subqueries))
+            return []
+
+    db = FakeManager()
+    monkeypatch.setattr(funding.models.database, "db", db)
+
+    asyncio.run(Proposal.fetch_listing(Proposal.listing()))
+    asyncio.run(Proposal.fetch_listing(Proposal.listing(), events=True, withdrawals=True))
+    assert db.calls[0][0] == "execute"
+    # one query each for the proposals, their events and their withdrawals
+    method, _, events, withdrawals = db.calls[1]
+    assert method == "prefetch"
+    assert events.model is Event
+    assert 'ORDER BY "t1"."created" DESC' in events.sql()[0]
+    assert withdrawals.model is Withdrawal
+
+
+@pytest.fixture(scope="module")
+def loop():
+    # the connection pool is bound to the loop it was opened on
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.run_until_complete(database.close_async())
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def proposals(loop):
+    try:
+        database.connect(reuse_if_open=True)
+    except Exception as ex:
+        pytest.skip(f"no database: {ex}")
+    database.create_tables([User, Proposal, Event])
+
+    tag = uuid4().hex[:8]
+    user = User.create(username=f"test_{tag}", password="-", mail=f"{tag}@example.org")
+    rows = []
+    for i in range(5):
+        p = Proposal.create(user=user, title=f"test {tag} {i}", addr_receiving="-",
+                            markdown="-", html="-", slug=f"test-{tag}-{i}", funds_target=100,
+                            status=ProposalStatus.funding_required)
+        for _ in range(3):
+            Event.create(proposal=p, user=user, message="test")
+        rows.append(p)
+    yield rows
+
+    Event.delete().where(Event.user == user).execute()
+    Proposal.delete().where(Proposal.user == user).execute()
+    user.delete_instance()
+    database.close()
+
+
+def test_listing_page(loop, proposals):
+    async def _page():
+        with assert_max_queries(1):
+            page = await paginate(Proposal.listing(Proposal.user == proposals[0].user), Proposal, limit=3)
+            return [(p.user.username, p.raised_pct, p.funds_target) for p in page]
+    assert len(loop.run_until_complete(_page())) == 3
+
+
+def test_by_slug(loop, proposals):
+    async def _get():
+        with assert_max_queries(2):
+            p = await Proposal.by_slug(proposals[0].slug)
+            return p.user.username, [e.message for e in p.events]
+    username, events = loop.run_until_complete(_get())
+    assert username == proposals[0].user.username
+    assert len(events) == 3
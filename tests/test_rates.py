@@ -0,0 +1,82 @@
+import asyncio
+import json
+
+import pytest
+from quart import Quart
+
+import settings
+from funding import factory
+from funding.utils.globals import COINS_LOOKUP
+from funding.utils.rates import Rates, StaticProvider, RATE_PROVIDERS
+
+
+class MemoryCache:
+    """Stand-in for the Redis session interface"""
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, val, expiry=None):
+        self.data[key] = val
+
+
+class FailingProvider:
+    async def fetch(self, coins, currencies):
+        raise Exception("offline")
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(factory, "coin", COINS_LOOKUP["wownero"])
+    monkeypatch.setattr(settings, "RATES_PROVIDER", "static")
+    monkeypatch.setattr(settings, "RATES_CURRENCIES", ["usd", "eur"])
+    monkeypatch.setitem(RATE_PROVIDERS, "static", lambda: StaticProvider(rate=0.25))
+    monkeypatch.setitem(RATE_PROVIDERS, "failing", FailingProvider)
+    app = Quart(__name__)
+    app.session_interface = MemoryCache()
+    return app
+
+
+def run(app, coro):
+    async def _run():
+        async with app.app_context():
+            return await coro
+    return asyncio.run(_run())
+
+
+def test_conversion(app):
+    rates = Rates()
+    assert rates.to_usd(10) == 0
+
+    run(app, rates.fetch())
+    assert rates.rate == 0.25
+    assert rates.to_usd(10) == 2.5
+    assert rates.to_fiat(3, "eur") == 0.75
+    assert rates.to_fiat(0.123, "usd") == 0.03
+    assert rates.to_fiat(10, "jpy") == 0
+    assert rates.to_usd(0) == 0
+
+
+def test_snapshot_shared(app, monkeypatch):
+    run(app, Rates().fetch())
+    snapshot = json.loads(app.session_interface.data["rates_snapshot"])
+    assert snapshot["rates"][factory.coin["coingecko_id"]] == {"usd": 0.25, "eur": 0.25}
+
+    # another worker picks the fresh snapshot up without fetching
+    other = Rates()
+    monkeypatch.setattr(settings, "RATES_PROVIDER", "failing")
+    run(app, other._rate_task())
+    assert other.to_usd(4) == 1.0
+
+
+def test_snapshot_kept_on_provider_error(app, monkeypatch):
+    rates = Rates()
+    run(app, rates.fetch())
+    before = app.session_interface.data["rates_snapshot"]
+
+    monkeypatch.setattr(settings, "RATES_PROVIDER", "failing")
+    assert run(app, rates.fetch()) == {}
+    assert app.session_interface.data["rates_snapshot"] == before
+    assert rates.to_usd(4) == 1.0
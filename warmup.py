@@ -0,0 +1,22 @@
+"""Prefetches the avatar thumbnails of all users into `data/gravatar`"""
+import asyncio
+
+from funding.factory import create_app, _setup_cache, gravatar, images
+
+app = create_app()
+
+
+async def main():
+    await _setup_cache(app)
+    # normally done by quart_session's `before_serving` hook
+    await app.session_interface.create(app)
+    async with app.app_context():
+        count = await gravatar.warmup()
+    await gravatar.close()
+    images.close()
+    print(f"Stored avatars for {count} users")
+    if not count:
+        raise SystemExit("No avatars stored; check the log above")
+
+
+asyncio.run(main())